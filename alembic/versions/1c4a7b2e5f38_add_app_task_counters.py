@@ -0,0 +1,106 @@
+"""add app task counters
+
+Revision ID: 1c4a7b2e5f38
+Revises: 3a1e5c0b9d27
+Create Date: 2026-10-18 14:02:55.318274
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c4a7b2e5f38'
+down_revision = '3a1e5c0b9d27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+COUNTERS = ('n_tasks', 'n_task_runs', 'n_expected_answers',
+            'n_delivered_answers')
+
+
+def upgrade():
+    for name in COUNTERS:
+        op.add_column('app', sa.Column(name, sa.Integer, server_default='0',
+                                       nullable=False))
+
+    op.execute('''
+        CREATE OR REPLACE FUNCTION app_task_counters() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE app SET n_tasks = n_tasks + 1,
+                n_expected_answers = n_expected_answers
+                    + COALESCE(NEW.n_answers, 30),
+                n_delivered_answers = n_delivered_answers
+                    + LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                WHERE id = NEW.app_id;
+                RETURN NEW;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE app SET n_tasks = n_tasks - 1,
+                n_expected_answers = n_expected_answers
+                    - COALESCE(OLD.n_answers, 30),
+                n_delivered_answers = n_delivered_answers
+                    - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30))
+                WHERE id = OLD.app_id;
+                RETURN OLD;
+            ELSE
+                IF NEW.n_answers IS DISTINCT FROM OLD.n_answers
+                   OR NEW.n_task_runs != OLD.n_task_runs THEN
+                    UPDATE app SET
+                    n_expected_answers = n_expected_answers
+                        + COALESCE(NEW.n_answers, 30)
+                        - COALESCE(OLD.n_answers, 30),
+                    n_delivered_answers = n_delivered_answers
+                        + LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                        - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30))
+                    WHERE id = NEW.app_id;
+                END IF;
+                RETURN NEW;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER app_task_counters AFTER INSERT OR UPDATE OR DELETE
+        ON task FOR EACH ROW EXECUTE PROCEDURE app_task_counters();
+
+        CREATE OR REPLACE FUNCTION app_task_run_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE app SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.app_id;
+                RETURN NEW;
+            ELSE
+                UPDATE app SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.app_id;
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER app_task_run_count AFTER INSERT OR DELETE ON task_run
+        FOR EACH ROW EXECUTE PROCEDURE app_task_run_count();
+        ''')
+
+    # Backfill the counters
+    op.execute('''
+        UPDATE app SET
+        n_tasks=counters.n_tasks,
+        n_expected_answers=counters.n_expected_answers,
+        n_delivered_answers=counters.n_delivered_answers
+        FROM (SELECT app_id, COUNT(id) AS n_tasks,
+              SUM(COALESCE(n_answers, 30)) AS n_expected_answers,
+              SUM(LEAST(n_task_runs, COALESCE(n_answers, 30)))
+              AS n_delivered_answers
+              FROM task GROUP BY app_id) AS counters
+        WHERE app.id=counters.app_id;
+        UPDATE app SET n_task_runs=counters.n_task_runs
+        FROM (SELECT app_id, COUNT(id) AS n_task_runs
+              FROM task_run GROUP BY app_id) AS counters
+        WHERE app.id=counters.app_id;
+        ''')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER app_task_run_count ON task_run')
+    op.execute('DROP FUNCTION app_task_run_count()')
+    op.execute('DROP TRIGGER app_task_counters ON task')
+    op.execute('DROP FUNCTION app_task_counters()')
+    for name in reversed(COUNTERS):
+        op.drop_column('app', name)
@@ -0,0 +1,24 @@
+"""add task app_id n_task_runs open index
+
+Revision ID: 2dcee8b7e9f6
+Revises: 4b6f2ad1d0c3
+Create Date: 2026-10-18 11:48:53.611027
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2dcee8b7e9f6'
+down_revision = '4b6f2ad1d0c3'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute('''
+        CREATE INDEX task_app_id_n_task_runs_open_idx
+        ON task (app_id, n_task_runs, id) WHERE state != 'completed';
+        ''')
+
+
+def downgrade():
+    op.execute('DROP INDEX task_app_id_n_task_runs_open_idx')
@@ -0,0 +1,26 @@
+"""add ip_location table
+
+Revision ID: 2e7b9a1d4f05
+Revises: 5d8e2f4a9c61
+Create Date: 2026-10-18 16:25:48.217530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e7b9a1d4f05'
+down_revision = '5d8e2f4a9c61'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'ip_location',
+        sa.Column('ip', sa.Text, primary_key=True),
+        sa.Column('loc', sa.Text),
+    )
+
+
+def downgrade():
+    op.drop_table('ip_location')
@@ -0,0 +1,25 @@
+"""add task_run app_id user indexes
+
+Revision ID: 3a1e5c0b9d27
+Revises: 2dcee8b7e9f6
+Create Date: 2026-10-18 12:21:07.148396
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1e5c0b9d27'
+down_revision = '2dcee8b7e9f6'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('task_run_app_id_user_id_idx', 'task_run',
+                    ['app_id', 'user_id', 'task_id'])
+    op.create_index('task_run_app_id_user_ip_idx', 'task_run',
+                    ['app_id', 'user_ip', 'task_id'])
+
+
+def downgrade():
+    op.drop_index('task_run_app_id_user_ip_idx')
+    op.drop_index('task_run_app_id_user_id_idx')
@@ -0,0 +1,128 @@
+"""count task runs once per app
+
+Revision ID: 3b9e6d2c7a14
+Revises: 4c1f8e3a7b92
+Create Date: 2026-10-18 19:48:06.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b9e6d2c7a14'
+down_revision = '4c1f8e3a7b92'
+
+from alembic import op
+
+
+# The app counters of a TaskRun are updated by task_run_count, in a single
+# UPDATE of the app row, instead of by app_task_run_count and by the update
+# of the task n_task_runs
+def upgrade():
+    op.execute('''
+        DROP TRIGGER app_task_run_count ON task_run;
+        DROP FUNCTION app_task_run_count();
+
+        CREATE OR REPLACE FUNCTION task_run_count() RETURNS trigger AS $$
+        DECLARE
+            runs integer;
+            answers integer;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE task SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.task_id
+                RETURNING n_task_runs, COALESCE(n_answers, 30)
+                INTO runs, answers;
+                UPDATE app SET n_task_runs = n_task_runs + 1,
+                n_delivered_answers = n_delivered_answers
+                    + CASE WHEN runs <= answers THEN 1 ELSE 0 END
+                WHERE id = NEW.app_id;
+                RETURN NEW;
+            ELSE
+                UPDATE task SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.task_id
+                RETURNING n_task_runs, COALESCE(n_answers, 30)
+                INTO runs, answers;
+                UPDATE app SET n_task_runs = n_task_runs - 1,
+                n_delivered_answers = n_delivered_answers
+                    - CASE WHEN runs < answers THEN 1 ELSE 0 END
+                WHERE id = OLD.app_id;
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        ''')
+    op.execute(APP_TASK_COUNTERS % dict(
+        changed='NEW.n_answers IS DISTINCT FROM OLD.n_answers'))
+
+
+def downgrade():
+    op.execute(APP_TASK_COUNTERS % dict(
+        changed='''NEW.n_answers IS DISTINCT FROM OLD.n_answers
+               OR NEW.n_task_runs != OLD.n_task_runs'''))
+    op.execute('''
+        CREATE OR REPLACE FUNCTION task_run_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE task SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.task_id;
+                RETURN NEW;
+            ELSE
+                UPDATE task SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.task_id;
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION app_task_run_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE app SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.app_id;
+                RETURN NEW;
+            ELSE
+                UPDATE app SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.app_id;
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER app_task_run_count AFTER INSERT OR DELETE ON task_run
+        FOR EACH ROW EXECUTE PROCEDURE app_task_run_count();
+        ''')
+
+
+APP_TASK_COUNTERS = '''
+    CREATE OR REPLACE FUNCTION app_task_counters() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE app SET n_tasks = n_tasks + 1,
+            n_expected_answers = n_expected_answers
+                + COALESCE(NEW.n_answers, 30),
+            n_delivered_answers = n_delivered_answers
+                + LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+            WHERE id = NEW.app_id;
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE app SET n_tasks = n_tasks - 1,
+            n_expected_answers = n_expected_answers
+                - COALESCE(OLD.n_answers, 30),
+            n_delivered_answers = n_delivered_answers
+                - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30))
+            WHERE id = OLD.app_id;
+            RETURN OLD;
+        ELSE
+            IF %(changed)s THEN
+                UPDATE app SET
+                n_expected_answers = n_expected_answers
+                    + COALESCE(NEW.n_answers, 30)
+                    - COALESCE(OLD.n_answers, 30),
+                n_delivered_answers = n_delivered_answers
+                    + LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                    - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30))
+                WHERE id = NEW.app_id;
+            END IF;
+            RETURN NEW;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+    '''
@@ -0,0 +1,24 @@
+"""add task app_id id open index
+
+Revision ID: 4b6f2ad1d0c3
+Revises: 586f108eb221
+Create Date: 2026-10-18 11:02:17.204611
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b6f2ad1d0c3'
+down_revision = '586f108eb221'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute('''
+        CREATE INDEX task_app_id_id_open_idx ON task (app_id, id)
+        WHERE state != 'completed';
+        ''')
+
+
+def downgrade():
+    op.execute('DROP INDEX task_app_id_id_open_idx')
@@ -0,0 +1,31 @@
+"""task open idx priority desc
+
+Revision ID: 4c1f8e3a7b92
+Revises: 2e7b9a1d4f05
+Create Date: 2026-10-18 19:12:30.552107
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c1f8e3a7b92'
+down_revision = '2e7b9a1d4f05'
+
+from alembic import op
+
+
+# The schedulers sort the open tasks by priority_0 DESC, id ASC, which the
+# index can only provide with the same mixed directions
+def upgrade():
+    op.execute('''
+        DROP INDEX IF EXISTS task_app_id_open_idx;
+        CREATE INDEX task_app_id_open_idx ON task (app_id, priority_0 DESC, id)
+        WHERE state != 'completed';
+        ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP INDEX task_app_id_open_idx;
+        CREATE INDEX task_app_id_open_idx ON task (app_id, priority_0, id)
+        WHERE state != 'completed';
+        ''')
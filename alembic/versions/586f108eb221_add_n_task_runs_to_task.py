@@ -0,0 +1,80 @@
+"""add n_task_runs to task
+
+Revision ID: 586f108eb221
+Revises: 46c3f68e950a, 1a18759fdad4
+Create Date: 2026-10-18 10:12:41.530182
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '586f108eb221'
+down_revision = ('46c3f68e950a', '1a18759fdad4')
+
+import json
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    op.add_column('task', sa.Column('n_task_runs', sa.Integer,
+                                    server_default='0', nullable=False))
+
+    # DEPRECATED: task.info.n_answers is now copied into task.n_answers
+    conn = op.get_bind()
+    sql = text('''SELECT id, info FROM task WHERE info LIKE('%n_answers%')''')
+    for row in conn.execute(sql):
+        n_answers = json.loads(row.info).get('n_answers')
+        if n_answers:
+            conn.execute(text('UPDATE task SET n_answers=:n WHERE id=:id'),
+                         n=int(n_answers), id=row.id)
+
+    op.execute('''
+        CREATE OR REPLACE FUNCTION task_state() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.n_task_runs >= COALESCE(NEW.n_answers, 30) THEN
+                NEW.state := 'completed';
+            ELSIF NEW.state = 'completed' THEN
+                NEW.state := 'ongoing';
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER task_state BEFORE INSERT OR UPDATE ON task
+        FOR EACH ROW EXECUTE PROCEDURE task_state();
+
+        CREATE OR REPLACE FUNCTION task_run_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE task SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.task_id;
+                RETURN NEW;
+            ELSE
+                UPDATE task SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.task_id;
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER task_run_count AFTER INSERT OR DELETE ON task_run
+        FOR EACH ROW EXECUTE PROCEDURE task_run_count();
+        ''')
+
+    # Backfill the counter; the task_state trigger sets the state
+    op.execute('''
+        UPDATE task SET n_task_runs=(SELECT COUNT(task_run.id)
+        FROM task_run WHERE task_run.task_id=task.id);
+        ''')
+    op.execute('''
+        CREATE INDEX task_app_id_open_idx ON task (app_id, priority_0 DESC, id)
+        WHERE state != 'completed';
+        ''')
+
+
+def downgrade():
+    op.execute('DROP INDEX task_app_id_open_idx')
+    op.execute('DROP TRIGGER task_run_count ON task_run')
+    op.execute('DROP FUNCTION task_run_count()')
+    op.execute('DROP TRIGGER task_state ON task')
+    op.execute('DROP FUNCTION task_state()')
+    op.drop_column('task', 'n_task_runs')
@@ -0,0 +1,41 @@
+"""add task_run daily rollup
+
+Revision ID: 5d8e2f4a9c61
+Revises: 1c4a7b2e5f38
+Create Date: 2026-10-18 15:40:12.604113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d8e2f4a9c61'
+down_revision = '1c4a7b2e5f38'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'task_run_daily_rollup',
+        sa.Column('app_id', sa.Integer,
+                  sa.ForeignKey('app.id', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('hour', sa.Integer, primary_key=True,
+                  autoincrement=False),
+        sa.Column('n_anon', sa.Integer, server_default='0', nullable=False),
+        sa.Column('n_auth', sa.Integer, server_default='0', nullable=False),
+    )
+    op.create_index('ix_task_run_daily_rollup_day', 'task_run_daily_rollup',
+                    ['day'])
+    op.create_table(
+        'rollup_watermark',
+        sa.Column('name', sa.Text, primary_key=True),
+        sa.Column('last_id', sa.Integer, server_default='0', nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('rollup_watermark')
+    op.drop_index('ix_task_run_daily_rollup_day')
+    op.drop_table('task_run_daily_rollup')
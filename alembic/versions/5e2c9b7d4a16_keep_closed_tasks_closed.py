@@ -0,0 +1,40 @@
+"""keep closed tasks closed
+
+Revision ID: 5e2c9b7d4a16
+Revises: 8d4b2f6e1a37
+Create Date: 2026-10-18 21:32:17.904215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2c9b7d4a16'
+down_revision = '8d4b2f6e1a37'
+
+from alembic import op
+
+
+TASK_STATE = '''
+    CREATE OR REPLACE FUNCTION task_state() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.n_task_runs >= COALESCE(NEW.n_answers, 30) THEN
+            NEW.state := 'completed';
+        ELSIF %(reopen)s THEN
+            NEW.state := 'ongoing';
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    '''
+
+
+# The task_state trigger only reopens the tasks completed by their counter,
+# so a task closed by its owner is not reopened by the next update
+def upgrade():
+    op.execute(TASK_STATE % dict(
+        reopen='''TG_OP = 'UPDATE' AND NEW.state = 'completed'
+              AND OLD.state = 'completed'
+              AND OLD.n_task_runs >= COALESCE(OLD.n_answers, 30)'''))
+
+
+def downgrade():
+    op.execute(TASK_STATE % dict(reopen="NEW.state = 'completed'"))
@@ -0,0 +1,58 @@
+"""rollup task_run deletes
+
+Revision ID: 6f3a8c1e9b20
+Revises: 3b9e6d2c7a14
+Create Date: 2026-10-18 20:21:37.915042
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6f3a8c1e9b20'
+down_revision = '3b9e6d2c7a14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('rollup_watermark', sa.Column('pending_id', sa.Integer))
+    op.add_column('rollup_watermark', sa.Column('pending_txid',
+                                                sa.BigInteger))
+    op.execute('''
+        CREATE OR REPLACE FUNCTION task_run_rollup_delete() RETURNS trigger
+        AS $$
+        DECLARE
+            watermark integer;
+        BEGIN
+            SELECT last_id INTO watermark FROM rollup_watermark
+            WHERE name = 'task_run_daily_rollup' FOR SHARE;
+            IF OLD.finish_time IS NOT NULL AND OLD.id <= watermark THEN
+                UPDATE task_run_daily_rollup SET
+                n_anon = n_anon
+                    - CASE WHEN OLD.user_id IS NULL THEN 1 ELSE 0 END,
+                n_auth = n_auth
+                    - CASE WHEN OLD.user_id IS NULL THEN 0 ELSE 1 END
+                WHERE app_id = OLD.app_id
+                AND day = date_trunc('day', OLD.finish_time::timestamp)::date
+                AND hour
+                    = EXTRACT(hour FROM OLD.finish_time::timestamp)::integer;
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER task_run_rollup_delete AFTER DELETE ON task_run
+        FOR EACH ROW EXECUTE PROCEDURE task_run_rollup_delete();
+        ''')
+    # The rollup may already count TaskRuns that were deleted, or miss some
+    # that were committed late, so it is rebuilt from scratch
+    op.execute('''
+        DELETE FROM task_run_daily_rollup;
+        DELETE FROM rollup_watermark WHERE name = 'task_run_daily_rollup';
+        ''')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER task_run_rollup_delete ON task_run')
+    op.execute('DROP FUNCTION task_run_rollup_delete()')
+    op.drop_column('rollup_watermark', 'pending_txid')
+    op.drop_column('rollup_watermark', 'pending_id')
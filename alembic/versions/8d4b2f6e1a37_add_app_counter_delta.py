@@ -0,0 +1,173 @@
+"""add app counter delta
+
+Revision ID: 8d4b2f6e1a37
+Revises: 6f3a8c1e9b20
+Create Date: 2026-10-18 21:05:44.381920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4b2f6e1a37'
+down_revision = '6f3a8c1e9b20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+COUNTERS = ('n_tasks', 'n_task_runs', 'n_expected_answers',
+            'n_delivered_answers')
+
+
+# The triggers add the changes of the app counters to app_counter_delta,
+# which is folded into the app rows periodically, so concurrent TaskRuns do
+# not wait on the lock of the app row
+def upgrade():
+    op.create_table(
+        'app_counter_delta',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('app_id', sa.Integer, nullable=False),
+        *[sa.Column(name, sa.Integer, server_default='0', nullable=False)
+          for name in COUNTERS])
+    op.create_index('ix_app_counter_delta_app_id', 'app_counter_delta',
+                    ['app_id'])
+    op.execute('''
+        CREATE OR REPLACE FUNCTION task_run_count() RETURNS trigger AS $$
+        DECLARE
+            runs integer;
+            answers integer;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE task SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.task_id
+                RETURNING n_task_runs, COALESCE(n_answers, 30)
+                INTO runs, answers;
+                INSERT INTO app_counter_delta
+                (app_id, n_task_runs, n_delivered_answers)
+                VALUES (NEW.app_id, 1,
+                        CASE WHEN runs <= answers THEN 1 ELSE 0 END);
+                RETURN NEW;
+            ELSE
+                UPDATE task SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.task_id
+                RETURNING n_task_runs, COALESCE(n_answers, 30)
+                INTO runs, answers;
+                INSERT INTO app_counter_delta
+                (app_id, n_task_runs, n_delivered_answers)
+                VALUES (OLD.app_id, -1,
+                        CASE WHEN runs < answers THEN -1 ELSE 0 END);
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION app_task_counters() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO app_counter_delta
+                (app_id, n_tasks, n_expected_answers, n_delivered_answers)
+                VALUES (NEW.app_id, 1, COALESCE(NEW.n_answers, 30),
+                        LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30)));
+                RETURN NEW;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO app_counter_delta
+                (app_id, n_tasks, n_expected_answers, n_delivered_answers)
+                VALUES (OLD.app_id, -1, -COALESCE(OLD.n_answers, 30),
+                        -LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30)));
+                RETURN OLD;
+            ELSE
+                IF NEW.n_answers IS DISTINCT FROM OLD.n_answers THEN
+                    INSERT INTO app_counter_delta
+                    (app_id, n_expected_answers, n_delivered_answers)
+                    VALUES (NEW.app_id,
+                        COALESCE(NEW.n_answers, 30)
+                        - COALESCE(OLD.n_answers, 30),
+                        LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                        - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30)));
+                END IF;
+                RETURN NEW;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        ''')
+
+
+def downgrade():
+    op.execute('''
+        CREATE OR REPLACE FUNCTION task_run_count() RETURNS trigger AS $$
+        DECLARE
+            runs integer;
+            answers integer;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE task SET n_task_runs = n_task_runs + 1
+                WHERE id = NEW.task_id
+                RETURNING n_task_runs, COALESCE(n_answers, 30)
+                INTO runs, answers;
+                UPDATE app SET n_task_runs = n_task_runs + 1,
+                n_delivered_answers = n_delivered_answers
+                    + CASE WHEN runs <= answers THEN 1 ELSE 0 END
+                WHERE id = NEW.app_id;
+                RETURN NEW;
+            ELSE
+                UPDATE task SET n_task_runs = n_task_runs - 1
+                WHERE id = OLD.task_id
+                RETURNING n_task_runs, COALESCE(n_answers, 30)
+                INTO runs, answers;
+                UPDATE app SET n_task_runs = n_task_runs - 1,
+                n_delivered_answers = n_delivered_answers
+                    - CASE WHEN runs < answers THEN 1 ELSE 0 END
+                WHERE id = OLD.app_id;
+                RETURN OLD;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION app_task_counters() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE app SET n_tasks = n_tasks + 1,
+                n_expected_answers = n_expected_answers
+                    + COALESCE(NEW.n_answers, 30),
+                n_delivered_answers = n_delivered_answers
+                    + LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                WHERE id = NEW.app_id;
+                RETURN NEW;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE app SET n_tasks = n_tasks - 1,
+                n_expected_answers = n_expected_answers
+                    - COALESCE(OLD.n_answers, 30),
+                n_delivered_answers = n_delivered_answers
+                    - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30))
+                WHERE id = OLD.app_id;
+                RETURN OLD;
+            ELSE
+                IF NEW.n_answers IS DISTINCT FROM OLD.n_answers THEN
+                    UPDATE app SET
+                    n_expected_answers = n_expected_answers
+                        + COALESCE(NEW.n_answers, 30)
+                        - COALESCE(OLD.n_answers, 30),
+                    n_delivered_answers = n_delivered_answers
+                        + LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                        - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30))
+                    WHERE id = NEW.app_id;
+                END IF;
+                RETURN NEW;
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+        ''')
+    # Fold the pending changes before dropping them
+    op.execute('''
+        UPDATE app SET n_tasks=app.n_tasks + sums.n_tasks,
+        n_task_runs=app.n_task_runs + sums.n_task_runs,
+        n_expected_answers=app.n_expected_answers + sums.n_expected_answers,
+        n_delivered_answers=app.n_delivered_answers
+            + sums.n_delivered_answers
+        FROM (SELECT app_id, SUM(n_tasks) AS n_tasks,
+              SUM(n_task_runs) AS n_task_runs,
+              SUM(n_expected_answers) AS n_expected_answers,
+              SUM(n_delivered_answers) AS n_delivered_answers
+              FROM app_counter_delta GROUP BY app_id) AS sums
+        WHERE app.id=sums.app_id;
+        ''')
+    op.drop_table('app_counter_delta')
@@ -4,6 +4,7 @@ import sys
 import optparse
 import inspect
 
+from sqlalchemy.sql import text
 import pybossa.model as model
 from pybossa.core import db
 import pybossa.web as web
@@ -65,6 +66,86 @@ def fixtures():
     db.session.commit()
 
 
+def update_task_counters(app_id=None):
+    '''Recompute the task and app counters (of one app)'''
+    from pybossa.cache import apps as cached_apps
+    if app_id:
+        app_ids = [int(app_id)]
+    else:
+        app_ids = [row.id for row in db.engine.execute('SELECT id FROM app')]
+    # One statement per app, so the task rows are not locked for long
+    sql = text('''UPDATE task SET n_task_runs=counts.n_task_runs
+               FROM (SELECT task.id, COUNT(task_run.id) AS n_task_runs
+                     FROM task LEFT JOIN task_run ON task.id=task_run.task_id
+                     WHERE task.app_id=:app_id GROUP BY task.id) AS counts
+               WHERE task.id=counts.id
+               AND task.n_task_runs != counts.n_task_runs''')
+    for app_id in app_ids:
+        result = db.engine.execute(sql, app_id=app_id)
+        # The triggers do not follow direct updates of n_task_runs
+        cached_apps.reset_app_counters(app_id)
+        print "App %s: %s tasks updated" % (app_id, result.rowcount)
+
+
+def fold_app_counters(batch_size=10000):
+    '''Add the pending changes of the task counters to the apps'''
+    from pybossa.cache import apps as cached_apps
+    total = 0
+    while True:
+        n = cached_apps.fold_app_counters(int(batch_size))
+        if not n:
+            break
+        total += n
+        print "%s counter changes folded" % total
+    print "The app counters are up to date"
+
+
+def scheduler_stats(reset=None):
+    '''Show the latency (ms) and DB queries per call of the schedulers'''
+    from pybossa.sched import schedulers
+    import pybossa.sched_stats as sched_stats
+    print "%-20s %8s %8s %8s %6s %6s %6s" % ('scheduler', 'calls',
+                                            'mean', 'queries', 'p50',
+                                            'p95', 'p99')
+    for name in schedulers:
+        s = sched_stats.get_stats(name)
+        if s['calls']:
+            print "%-20s %8d %8.1f %8.1f %6s %6s %6s" % (
+                name, s['calls'], s['time_ms'], s['queries'],
+                s['p50'] or '>5000', s['p95'] or '>5000', s['p99'] or '>5000')
+        if reset:
+            sched_stats.reset_stats(name)
+
+
+def warm_cache(n_pages=3, n_apps=20, processes=4):
+    '''Compute the cached front page, category pages and app counters'''
+    from pybossa.cache import warm
+    jobs = warm.get_jobs(int(n_pages), int(n_apps))
+    failed = 0
+    for (module, name, args), seconds, error in warm.warm(jobs,
+                                                          int(processes)):
+        call = "%s.%s%r" % (module, name, tuple(args))
+        if error:
+            failed += 1
+            print "%s failed: %s" % (call, error)
+        else:
+            print "%s: %.2fs" % (call, seconds)
+    print "%s calls warmed up, %s failed" % (len(jobs) - failed, failed)
+
+
+def update_stats_rollup(batch_size=100000):
+    '''Add the task runs submitted since the last run to the stats rollup'''
+    import pybossa.stats as stats
+    total = 0
+    while True:
+        n = stats.update_rollup(int(batch_size))
+        if not n:
+            break
+        total += n
+        print "%s task run ids rolled up" % total
+    print "The stats rollup is up to date"
+
+
 ## ==================================================
 ## Misc stuff for setting up a command line interface
 
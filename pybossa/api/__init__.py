@@ -57,6 +57,9 @@ cors_headers = ['Content-Type', 'Authorization']
 
 error = ErrorStatus()
 
+# Maximum number of tasks returned by a single newtask request
+MAX_NEW_TASKS = 100
+
 
 @blueprint.route('/')
 @crossdomain(origin='*', headers=cors_headers)
@@ -109,6 +112,11 @@ def new_task(app_id):
             offset = int(request.args.get('offset'))
         else:
             offset = 0
+        if request.args.get('limit'):
+            limit = min(max(int(request.args.get('limit')), 1),
+                        MAX_NEW_TASKS)
+        else:
+            limit = None
             
         # Identify the current user
         fb_user_id = request.args.get('facebook_user_id')
@@ -119,6 +127,11 @@ def new_task(app_id):
             fb_user = fb_api.get_user_by_fb_id(int(fb_user_id))
             user_id = fb_user.id
         user_ip = request.remote_addr if current_user.is_anonymous() and fb_user_id == None else None    
+        # Return a list of tasks if a limit was requested
+        if limit:
+            tasks = sched.new_tasks(app_id, user_id, user_ip, offset, limit)
+            return Response(json.dumps([t.dictize() for t in tasks]),
+                            mimetype="application/json")
         task = sched.new_task(app_id, user_id, user_ip, offset)
         # If there is a task for the user, return it
         if task:
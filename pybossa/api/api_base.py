@@ -27,11 +27,14 @@ This package adds GET, POST, PUT and DELETE methods for any class:
 
 """
 import json
-from flask import request, abort, Response
+from flask import request, abort, Response, stream_with_context
 from flask.views import MethodView
 from werkzeug.exceptions import NotFound
+from werkzeug.urls import url_encode
+from itsdangerous import BadData
+from sqlalchemy.orm import defer
 from pybossa.util import jsonpify, crossdomain
-from pybossa.core import db
+from pybossa.core import db, signer
 from pybossa.auth import require
 from pybossa.hateoas import Hateoas
 from pybossa.ratelimit import ratelimit
@@ -40,6 +43,14 @@ from facebook import UserFbAPI
 
 cors_headers = ['Content-Type', 'Authorization']
 
+# Arguments that control the response, not used for filtering the query
+reserved_args = ['limit', 'offset', 'last_id', 'cursor', 'links', 'fields',
+                 'api_key']
+
+# Number of items serialized and written to the response at a time by the
+# list GETs
+CHUNK_SIZE = 100
+
 error = ErrorStatus()
 
 
@@ -49,6 +60,9 @@ class APIBase(MethodView):
 
     hateoas = Hateoas()
 
+    #: Columns always loaded, even if they are not in the fields arg
+    required_fields = ('id',)
+
     def valid_args(self):
         """Check if the domain object args are valid."""
         for k in request.args.keys():
@@ -77,8 +91,13 @@ class APIBase(MethodView):
         try:
             getattr(require, self.__class__.__name__.lower()).read()
             query = self._db_query(self.__class__, id)
-            json_response = self._create_json_response(query, id)
-            return Response(json_response, mimetype='application/json')
+            if id:
+                json_response = self._create_json_response(query, id)
+                return Response(json_response, mimetype='application/json')
+            json_response = self._create_json_stream(query)
+            response = Response(json_response, mimetype='application/json')
+            self._add_next_page_link(response, query)
+            return response
         except Exception as e:
             return error.format_exception(
                 e,
@@ -94,11 +113,51 @@ class APIBase(MethodView):
             items = items[0]
         return json.dumps(items)
 
+    def _create_json_stream(self, query):
+        """Return a generator with the JSON list of the items of the query,
+        so only CHUNK_SIZE items are in memory at a time"""
+        items = iter(query)
+        # Run the query now, so its errors are reported as usual
+        first = next(items, None)
+
+        def dumps(chunk):
+            return ', '.join(json.dumps(self._create_dict_from_model(item))
+                             for item in chunk)
+
+        def generate():
+            if first is None:
+                yield '[]'
+                return
+            start = '['
+            chunk = [first]
+            for item in items:
+                if len(chunk) == CHUNK_SIZE:
+                    yield start + dumps(chunk)
+                    start = ', '
+                    chunk = []
+                chunk.append(item)
+            yield start + dumps(chunk) + ']'
+
+        return stream_with_context(generate())
+
     def _create_dict_from_model(self, model):
-        return self._select_attributes(self._add_hateoas_links(model))
+        obj = self._select_attributes(self._add_hateoas_links(model))
+        fields = self._fields()
+        if fields:
+            for name in obj.keys():
+                if name not in fields and name not in ('link', 'links'):
+                    del obj[name]
+        return obj
 
     def _add_hateoas_links(self, item):
-        obj = item.dictize()
+        fields = self._loaded_fields()
+        if fields:
+            obj = dict((name, getattr(item, name)) for name in fields)
+        else:
+            obj = item.dictize()
+        # Bulk consumers can skip the links with links=0
+        if request.args.get('links') == '0':
+            return obj
         links, link = self.hateoas.create_links(item)
         if links:
             obj['links'] = links
@@ -107,10 +166,20 @@ class APIBase(MethodView):
         return obj
 
     def _db_query(self, cls, id):
-        """ Returns a list with the results of the query"""
+        """ Returns the query of the items, or a list with the item if an id
+        is given"""
         query = db.session.query(self.__class__)
+        fields = self._loaded_fields()
+        if fields:
+            # Do not even fetch the columns that were not requested
+            query = query.options(*[defer(c.name) for c
+                                    in self.__class__.__table__.c
+                                    if c.name not in fields])
         if not id:
             limit, offset = self._set_limit_and_offset()
+            last_id = self._set_last_id()
+            if last_id is not None:
+                query = query.filter(self.__class__.id > last_id)
             query = self._filter_query(query, limit, offset)
         else:
             query = [query.get(id)]
@@ -118,7 +187,7 @@ class APIBase(MethodView):
 
     def _filter_query(self, query, limit, offset):
         for k in request.args.keys():
-            if k not in ['limit', 'offset', 'api_key']:
+            if k not in reserved_args:
                 # Raise an error if the k arg is not a column
                 getattr(self.__class__, k)
                 query = query.filter(
@@ -130,19 +199,86 @@ class APIBase(MethodView):
         query = query.order_by(self.__class__.id)
         query = query.limit(limit)
         query = query.offset(offset)
-        return query.all()
+        query = query.execution_options(stream_results=True)
+        return query.yield_per(CHUNK_SIZE)
 
     def _set_limit_and_offset(self):
         try:
             limit = min(10000, int(request.args.get('limit')))
         except (ValueError, TypeError):
             limit = 20
+        if limit < 1:
+            raise ValueError('Invalid limit')
         try:
             offset = int(request.args.get('offset'))
         except (ValueError, TypeError):
             offset = 0
+        # A page after a cursor or a last_id starts right after that id
+        if request.args.get('cursor') or request.args.get('last_id'):
+            offset = 0
         return limit, offset
 
+    def _fields(self):
+        """Return the columns requested with the fields arg, or None for all
+        of them"""
+        fields = request.args.get('fields')
+        if not fields:
+            return None
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+        columns = self.__class__.__table__.c
+        for name in fields:
+            if name not in columns:
+                raise AttributeError("type object '%s' has no column '%s'"
+                                     % (self.__class__.__name__, name))
+        return fields
+
+    def _loaded_fields(self):
+        """Return the requested columns plus the ones needed to build the
+        response (like the ids for the links), or None for all of them"""
+        fields = self._fields()
+        if fields is None:
+            return None
+        fields = set(fields).union(self.required_fields)
+        if request.args.get('links') != '0':
+            cls = self.__class__.__name__.lower()
+            fields.update(key for rel, key, title
+                          in self.hateoas.foreign_keys.get(cls, []))
+        return [c.name for c in self.__class__.__table__.c
+                if c.name in fields]
+
+    def _set_last_id(self):
+        """Return the id after which the page starts, from the opaque cursor
+        of the previous page or from the last_id arg"""
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                return int(signer.loads(cursor, salt='api-cursor'))
+            except BadData:
+                raise ValueError('Invalid cursor')
+        last_id = request.args.get('last_id')
+        if last_id:
+            return int(last_id)
+        return None
+
+    def _add_next_page_link(self, response, query):
+        """Add a Link header with the URL of the next page, which starts after
+        the last item of this page, so it costs the same as the first one
+        whatever the page"""
+        limit, offset = self._set_limit_and_offset()
+        # The items are streamed, so probe the index for the id of the last
+        # item of the page and for an item after it
+        ids = query.with_entities(self.__class__.id)\
+                   .offset(offset + limit - 1).limit(2).all()
+        if len(ids) < 2:
+            return
+        last_id = ids[0][0]
+        args = request.args.copy()
+        args.pop('offset', None)
+        args.pop('last_id', None)
+        args['cursor'] = signer.dumps(last_id, salt='api-cursor')
+        url = '%s?%s' % (request.base_url, url_encode(args))
+        response.headers['Link'] = '<%s>; rel="next"' % url
+
     @jsonpify
     @crossdomain(origin='*', headers=cors_headers)
     @ratelimit(limit=300, per=15 * 60)
@@ -167,6 +303,7 @@ class APIBase(MethodView):
 
             # Clean HATEOAS args
             data = self.hateoas.remove_links(data)
+            data = self._remove_readonly_attributes(data)
             inst = self.__class__(**data)
             if fb_user == None:
                 self._update_object(inst)
@@ -237,6 +374,7 @@ class APIBase(MethodView):
             data['id'] = id
             # Clean HATEOAS args
             data = self.hateoas.remove_links(data)
+            data = self._remove_readonly_attributes(data)
             inst = self.__class__(**data)
             db.session.merge(inst)
             db.session.commit()
@@ -270,6 +408,13 @@ class APIBase(MethodView):
         pass
 
 
+    def _remove_readonly_attributes(self, data):
+        """Method to be overriden in inheriting classes which have
+        attributes that are maintained by the DB and cannot be set by clients
+        """
+        return data
+
+
     def _select_attributes(self, item_data):
         """Method to be overriden in inheriting classes in case it is not
         desired that every object attribute is returned by the API
@@ -41,6 +41,14 @@ class AppAPI(APIBase):
 
     def _refresh_cache(self, obj):
         cached_apps.delete_app(obj.short_name)
+        cached_apps.clean(obj.id, obj.category_id)
+
+    def _remove_readonly_attributes(self, data):
+        """The task counters are maintained by the DB."""
+        for name in ('n_tasks', 'n_task_runs', 'n_expected_answers',
+                     'n_delivered_answers'):
+            data.pop(name, None)
+        return data
 
     def _update_object(self, obj):
         if not current_user.is_anonymous():
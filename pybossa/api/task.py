@@ -31,3 +31,8 @@ class TaskAPI(APIBase):
     """Class for domain object Task."""
 
     __class__ = Task
+
+    def _remove_readonly_attributes(self, data):
+        """n_task_runs is maintained by the DB when TaskRuns are submitted."""
+        data.pop('n_task_runs', None)
+        return data
@@ -50,6 +50,9 @@ class UserAPI(APIBase):
     # has privacy_mode disabled
     allowed_attributes = ('name', 'locale', 'fullname', 'created')
 
+    # privacy_mode is needed to select the attributes of each user
+    required_fields = ('id', 'privacy_mode')
+
 
     def _select_attributes(self, user_data):
         privacy = self._is_user_private(user_data)
@@ -19,32 +19,145 @@
 """
 This module exports a set of decorators for caching functions.
 
+Values are kept in Redis and, for a few seconds, in a small in-process LRU
+cache in front of it. When a value expires only one worker recomputes it while
+holding a Redis lock, and hot values are recomputed a bit before they expire
+(probabilistic early refresh), so an expiry does not hit the DB from every
+worker at once.
+
 It exports:
     * cache: for caching functions without parameters
     * memoize: for caching functions using its arguments as part of the key
+    * memoize_many: for caching the batch version of a memoized function
     * delete_cached: to remove a cached value
     * delete_memoized: to remove a cached value from the memoize decorator
+    * invalidate_tag: to remove every cached value tagged with a dependency
+    * get_metrics: for getting the hit, miss and latency counters
 
 """
 import os
+import math
+import time
+import random
+import uuid
 import hashlib
+import inspect
+import threading
+from collections import OrderedDict
 from functools import wraps
+from redis.exceptions import ResponseError
 from pybossa.core import redis_master, redis_slave
-try:
-    import cPickle as pickle
-except ImportError:  # pragma: no cover
-    import pickle
+from pybossa.cache.serializer import get_serializer, COMPRESS_MIN_SIZE
+from pybossa.cache.metrics import CacheMetrics
 
 try:
     import settings_local as settings
 except ImportError:  # pragma: no cover
     os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
+else:
+    serializer = get_serializer(
+        getattr(settings, 'REDIS_CACHE_SERIALIZER', 'json'),
+        getattr(settings, 'REDIS_CACHE_COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE))
+    metrics = CacheMetrics(settings.REDIS_KEYPREFIX)
 
 ONE_DAY = 24 * 60 * 60
 ONE_HOUR = 60 * 60
 HALF_HOUR = 30 * 60
 FIVE_MINUTES = 5 * 60
 
+# In-process cache: max number of values and seconds they are kept
+LOCAL_MAXSIZE = 1000
+LOCAL_TIMEOUT = 5
+# Seconds a worker can hold the lock for recomputing a value
+LOCK_TIMEOUT = 30
+# Seconds other workers wait for that value before computing it themselves
+LOCK_WAIT = 5
+# Values greater than 1 favour earlier refreshes
+EARLY_REFRESH_BETA = 1.0
+# Tag sets drop the keys that already expired every time this many are added
+TAG_PRUNE_SIZE = 1000
+# Keys deleted per Redis call when a tag is invalidated
+INVALIDATE_BATCH_SIZE = 500
+
+MISSING = object()
+
+
+class LocalCache(object):
+    """
+    Thread safe LRU cache with a size bound, whose values expire after
+    timeout seconds.
+
+    """
+
+    def __init__(self, maxsize=LOCAL_MAXSIZE, timeout=LOCAL_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or MISSING."""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[1] < time.time():
+                return MISSING
+            self._data[key] = item
+            return item[0]
+
+    def set(self, key, value, timeout=None):
+        """Store a value, for at most the local timeout."""
+        timeout = min(timeout or self.timeout, self.timeout)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + timeout)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove the value for key."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all the values."""
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalCache()
+
+
+# Adds a key to the sets of its tags, which live as long as their keys, and
+# drops the expired keys from a set each time it grows by ARGV[3] members
+# KEYS are pairs of a tag set and the counter of the keys added to it, which
+# drives the pruning, as the size of the set stays put once it is pruned
+TAG_SCRIPT = redis_master.register_script('''
+    for i = 1, #KEYS, 2 do
+        local tag, adds = KEYS[i], KEYS[i + 1]
+        if redis.call('sadd', tag, ARGV[1]) == 1 then
+            local n = redis.call('incr', adds)
+            if n == 1 then
+                redis.call('expire', adds, ARGV[2])
+            end
+            if n % tonumber(ARGV[3]) == 0 then
+                for _, key in ipairs(redis.call('smembers', tag)) do
+                    if redis.call('exists', key) == 0 then
+                        redis.call('srem', tag, key)
+                    end
+                end
+            end
+        end
+        if redis.call('ttl', tag) < tonumber(ARGV[2]) then
+            redis.call('expire', tag, ARGV[2])
+            redis.call('expire', adds, ARGV[2])
+        end
+    end''')
+
+
+def get_key_prefix():
+    """Return the prefix of the cache keys, with the format of the values."""
+    return "%s:%s" % (settings.REDIS_KEYPREFIX, serializer.prefix)
+
 
 def get_key_to_hash(*args, **kwargs):
     """Return key to hash for *args and **kwargs."""
@@ -65,67 +178,286 @@ def get_hash_key(prefix, key_to_hash):
     return key
 
 
-def cache(key_prefix, timeout=300):
+def must_refresh(delta, expiry, now=None, beta=EARLY_REFRESH_BETA):
+    """
+    Return True if a value that took delta seconds to compute and expires at
+    expiry should be recomputed now.
+
+    The closer the expiry and the slower the function, the more likely.
+
+    """
+    now = now or time.time()
+    return now - delta * beta * math.log(1.0 - random.random()) >= expiry
+
+
+def get_tag_key(tag):
+    """Return the key of the Redis set with the keys of a tag."""
+    return "%s:tag:%s" % (get_key_prefix(), tag)
+
+
+def get_tag_script_keys(tags):
+    """Return the keys TAG_SCRIPT is called with for the tags."""
+    keys = []
+    for tag in tags:
+        tag_key = get_tag_key(tag)
+        keys.extend([tag_key, "%s:adds" % tag_key])
+    return keys
+
+
+def get_tags(templates, f, *args, **kwargs):
+    """Return the tags of a call, formatting the templates with the
+    arguments of f by name, i.e. 'app:{app_id}'."""
+    if not templates:
+        return []
+    callargs = inspect.getcallargs(f, *args, **kwargs)
+    return [unicode(template).format(**callargs) for template in templates]
+
+
+def get_cached_value(key, timeout, f, args, kwargs, tags=(), name=None):
+    """Return the value for key from the cache, computing it with f if needed.
+
+    The key is added to the given tags when the value is stored, and the call
+    is recorded in the metrics of name (the name of f by default).
+
+    """
+    name = name or f.__name__
+    # The local cache keeps the serialized values, so callers never share
+    # (and modify) the same objects
+    cached = local_cache.get(key)
+    if cached is not MISSING:
+        metrics.record(name, hits=1, local_hits=1)
+        return serializer.loads(cached)[0]
+    lock = key + ':lock'
+    start = time.time()
+    cached = redis_slave.get(key)
+    redis_ms = (time.time() - start) * 1000
+    if cached:
+        metrics.record(name, hits=1, redis_calls=1, redis_ms=redis_ms,
+                       bytes=len(cached))
+        output, delta, expiry = serializer.loads(cached)
+        if not must_refresh(delta, expiry) or not _acquire(lock):
+            local_cache.set(key, cached, timeout)
+            return output
+        return _compute(key, timeout, lock, f, args, kwargs, tags, name)
+    metrics.record(name, misses=1, redis_calls=1, redis_ms=redis_ms)
+    if _acquire(lock):
+        return _compute(key, timeout, lock, f, args, kwargs, tags, name)
+    # Another worker is computing the value
+    for i in range(int(LOCK_WAIT / 0.05)):
+        time.sleep(0.05)
+        cached = redis_slave.get(key)
+        if cached:
+            local_cache.set(key, cached, timeout)
+            return serializer.loads(cached)[0]
+    return _compute(key, timeout, None, f, args, kwargs, tags, name)
+
+
+def _acquire(lock):
+    return redis_master.set(lock, 1, nx=True, ex=LOCK_TIMEOUT)
+
+
+def _compute(key, timeout, lock, f, args, kwargs, tags, name):
+    try:
+        start = time.time()
+        output = f(*args, **kwargs)
+        now = time.time()
+        cached = serializer.dumps([output, now - start, now + timeout])
+        redis_master.setex(key, timeout, cached)
+        if tags:
+            TAG_SCRIPT(keys=get_tag_script_keys(tags),
+                       args=[key, timeout, TAG_PRUNE_SIZE])
+        local_cache.set(key, cached, timeout)
+        metrics.record(name, compute_ms=(now - start) * 1000,
+                       redis_calls=1, redis_ms=(time.time() - now) * 1000,
+                       bytes=len(cached))
+        return output
+    finally:
+        if lock:
+            redis_master.delete(lock)
+
+
+def cache(key_prefix, timeout=300, tags=None):
     """
     Decorator for caching functions.
 
-    Returns the function value from cache, or the function if cache disabled
+    Returns the function value from cache, or the function if cache disabled.
+    The value is removed by invalidate_tag for any of the given tags.
 
     """
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
-                key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
-                output = redis_slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                else:
-                    output = f(*args, **kwargs)
-                    redis_master.setex(key, timeout, pickle.dumps(output))
-                    return output
+                key = "%s::%s" % (get_key_prefix(), key_prefix)
+                return get_cached_value(key, timeout, f, args, kwargs,
+                                        tags or (), key_prefix)
             else:
                 return f(*args, **kwargs)
         return wrapper
     return decorator
 
 
-def memoize(timeout=300, debug=False):
+def memoize(timeout=300, debug=False, tags=None, key_builder=None):
     """
     Decorator for caching functions using its arguments as part of the key.
 
-    Returns the cached value, or the function if the cache is disabled
+    Returns the cached value, or the function if the cache is disabled.
+    The tags are formatted with the arguments of the call, i.e.
+    memoize(tags=['app:{app_id}']), and the value is removed by
+    invalidate_tag for any of them.
+
+    By default the key is a hash of all the arguments. A key_builder, called
+    with the same arguments as the function, can return a short string to use
+    instead, for functions whose arguments are large values derived from a
+    smaller one.
 
     """
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
-                key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, f.__name__)
-                key_to_hash = get_key_to_hash(*args, **kwargs)
-                key = get_hash_key(key, key_to_hash)
-                print "Memoize %s" % key
-                output = redis_slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                else:
-                    output = f(*args, **kwargs)
-                    redis_master.setex(key, timeout, pickle.dumps(output))
-                    return output
+                key = get_memoize_key(wrapper, *args, **kwargs)
+                call_tags = get_tags(tags, f, *args, **kwargs)
+                return get_cached_value(key, timeout, f, args, kwargs,
+                                        call_tags)
             else:
                 return f(*args, **kwargs)
+        wrapper.timeout = timeout
+        wrapper.tags = tags
+        wrapper.uncached = f
+        wrapper.key_builder = key_builder
+        return wrapper
+    return decorator
+
+
+def memoize_many(function):
+    """
+    Decorator for the batch version of a memoized function of one argument.
+
+    The decorated function takes a list of arguments and returns a dict with
+    the value for each of them. The cached values are read with a single MGET
+    and only the missing ones are passed to the decorated function. They are
+    stored in a pipeline with the keys, timeout and tags of the memoized
+    function, so both share the cache.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(args):
+            args = list(OrderedDict.fromkeys(args))
+            if not args:
+                return {}
+            if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
+                output = {}
+                pending = []
+                name = function.__name__
+                for arg in args:
+                    key = get_memoize_key(function, arg)
+                    cached = local_cache.get(key)
+                    if cached is MISSING:
+                        pending.append((arg, key))
+                    else:
+                        output[arg] = serializer.loads(cached)[0]
+                metrics.record(name, hits=len(output), local_hits=len(output))
+                if not pending:
+                    return output
+                missing = []
+                start = time.time()
+                values = redis_slave.mget([key for arg, key in pending])
+                redis_ms = (time.time() - start) * 1000
+                for (arg, key), cached in zip(pending, values):
+                    if cached:
+                        local_cache.set(key, cached, function.timeout)
+                        output[arg] = serializer.loads(cached)[0]
+                    else:
+                        missing.append((arg, key))
+                metrics.record(name, hits=len(pending) - len(missing),
+                               misses=len(missing), redis_calls=1,
+                               redis_ms=redis_ms,
+                               bytes=sum(len(v) for v in values if v))
+                if missing:
+                    output.update(_compute_many(function, f, missing))
+                return output
+            else:
+                return f(args)
         return wrapper
     return decorator
 
 
+def _compute_many(function, f, missing):
+    timeout = function.timeout
+    start = time.time()
+    values = f([arg for arg, key in missing])
+    now = time.time()
+    delta = (now - start) / len(missing)
+    output = {}
+    size = 0
+    pipe = redis_master.pipeline(transaction=False)
+    for arg, key in missing:
+        output[arg] = values.get(arg)
+        cached = serializer.dumps([output[arg], delta, now + timeout])
+        size += len(cached)
+        pipe.setex(key, timeout, cached)
+        tags = get_tags(function.tags, function.uncached, arg)
+        if tags:
+            TAG_SCRIPT(keys=get_tag_script_keys(tags),
+                       args=[key, timeout, TAG_PRUNE_SIZE], client=pipe)
+        local_cache.set(key, cached, timeout)
+    pipe.execute()
+    metrics.record(function.__name__, compute_ms=(now - start) * 1000,
+                   redis_calls=1, redis_ms=(time.time() - now) * 1000,
+                   bytes=size)
+    return output
+
+
+def get_memoize_key(function, *args, **kwargs):
+    """Return the key of a memoized call."""
+    key = "%s:%s_args:%s" % (get_key_prefix(), function.__name__,
+                             get_function_version(function))
+    key_builder = getattr(function, 'key_builder', None)
+    if key_builder:
+        return "%s:%s" % (key, key_builder(*args, **kwargs))
+    return get_hash_key(key, get_key_to_hash(*args, **kwargs))
+
+
+def get_version_key(function):
+    """Return the key of the version of the memoized values of a function."""
+    return "%s:%s_version" % (get_key_prefix(), function.__name__)
+
+
+def get_function_version(function):
+    """
+    Return the version of the memoized values of a function, which is part of
+    their keys. It is empty until delete_memoized removes all the values.
+
+    The version is kept in the in-process cache, so other workers can use the
+    old values for as long as they keep them there.
+
+    """
+    key = get_version_key(function)
+    version = local_cache.get(key)
+    if version is MISSING:
+        version = redis_slave.get(key) or ''
+        local_cache.set(key, version)
+    return version
+
+
 def delete_memoized(function, *args, **kwargs):
     """
     Delete a memoized value from the cache.
 
+    Without arguments every memoized value of the function is deleted, by
+    changing the version of their keys. The old values expire on their own.
+
     Returns True if success
 
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
+        if not args and not kwargs:
+            key = get_version_key(function)
+            redis_master.incr(key)
+            local_cache.delete(key)
+            return True
         keys = []
         #if arg:
         #    key_to_hash = ":%s" % arg
@@ -138,12 +470,10 @@ def delete_memoized(function, *args, **kwargs):
         #    key = "%s:%s_args::*" % (settings.REDIS_KEYPREFIX,
         #                             function.__name__)
         #    keys = redis_master.keys(key)
-        key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, function.__name__)
-        key_to_hash = get_key_to_hash(*args, **kwargs)
-        key = get_hash_key(key, key_to_hash)
-        print "Deleting memoized key: %s" % key
+        key = get_memoize_key(function, *args, **kwargs)
         #for k in keys:
         #    redis_master.delete(k)
+        local_cache.delete(key)
         redis_master.delete(key)
         return True
 
@@ -156,5 +486,59 @@ def delete_cached(key):
 
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
-        key = "%s::%s" % (settings.REDIS_KEYPREFIX, key)
+        key = "%s::%s" % (get_key_prefix(), key)
+        local_cache.delete(key)
         return redis_master.delete(key)
+
+
+def invalidate_tag(*tags):
+    """
+    Delete every cached value tagged with any of the tags.
+
+    The tag set is renamed first, so values tagged meanwhile are kept in a new
+    one, and its keys are deleted in batches to not block Redis.
+
+    Returns the number of deleted values
+
+    """
+    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
+        deleted = 0
+        for tag in tags:
+            tag_key = get_tag_key(tag)
+            detached = "%s:%s" % (tag_key, uuid.uuid4().hex)
+            try:
+                redis_master.rename(tag_key, detached)
+            except ResponseError:
+                # No value has the tag
+                continue
+            keys = []
+            for key in redis_master.sscan_iter(detached,
+                                               count=INVALIDATE_BATCH_SIZE):
+                keys.append(key)
+                if len(keys) == INVALIDATE_BATCH_SIZE:
+                    deleted += _delete_keys(keys)
+                    keys = []
+            deleted += _delete_keys(keys)
+            redis_master.delete(detached)
+        return deleted
+    return 0
+
+
+def _delete_keys(keys):
+    for key in keys:
+        local_cache.delete(key)
+    if keys:
+        redis_master.delete(*keys)
+    return len(keys)
+
+
+def get_metrics():
+    """
+    Return the hit, miss and latency counters of the cached functions.
+
+    Returns a dict by function name (or key prefix for the cache decorator)
+
+    """
+    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:  # pragma: no cover
+        return metrics.get()
+    return {}
@@ -20,7 +20,8 @@ from sqlalchemy.sql import func, text
 from pybossa.core import db
 from pybossa.model import Featured, App, TaskRun, Task
 from pybossa.util import pretty_date
-from pybossa.cache import memoize, cache, delete_memoized, delete_cached
+from pybossa.cache import memoize, memoize_many, cache, delete_memoized, \
+    delete_cached, invalidate_tag
 
 import json
 import string
@@ -31,25 +32,31 @@ from datetime import timedelta
 
 STATS_FRONTPAGE_TIMEOUT = 12 * 60 * 60
 
-@memoize()
 def get_app(short_name):
+    """Return a (not persistent) App, built from the cached values"""
+    return App(**get_app_dict(short_name))
+
+
+@memoize()
+def get_app_dict(short_name):
     sql = text('''SELECT * FROM
                   app WHERE app.short_name=:short_name''')
     results = db.engine.execute(sql, short_name=short_name)
-    app = App()
+    app = dict()
     for row in results:
-        app = App(id=row.id, name=row.name, short_name=row.short_name,
-                  created=row.created,
-                  description=row.description,
-                  long_description=row.long_description,
-                  owner_id=row.owner_id,
-                  hidden=row.hidden,
-                  info=json.loads(row.info),
-                  allow_anonymous_contributors=row.allow_anonymous_contributors)
+        app = dict(id=row.id, name=row.name, short_name=row.short_name,
+                   created=row.created,
+                   description=row.description,
+                   long_description=row.long_description,
+                   owner_id=row.owner_id,
+                   hidden=row.hidden,
+                   info=json.loads(row.info),
+                   allow_anonymous_contributors=row.allow_anonymous_contributors)
     return app
 
 
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="front_page_featured_apps")
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="front_page_featured_apps",
+       tags=['featured'])
 def get_featured_front_page():
     """Return featured apps"""
     sql = text('''SELECT app.id, app.name, app.short_name, app.info FROM
@@ -82,52 +89,140 @@ def get_top(n=4):
     return top_apps
 
 
-@memoize()
+# The counters are maintained by the app_task_counters and
+# task_run_count triggers, so reading them does not depend on the size of
+# the app. They are the columns of the app plus the changes not folded yet.
+# Filter it by id to use the indexes.
+APP_COUNTERS_SQL = '''
+    (SELECT app.id,
+     app.n_tasks + COALESCE(SUM(delta.n_tasks), 0) AS n_tasks,
+     app.n_task_runs + COALESCE(SUM(delta.n_task_runs), 0) AS n_task_runs,
+     app.n_expected_answers + COALESCE(SUM(delta.n_expected_answers), 0)
+     AS n_expected_answers,
+     app.n_delivered_answers + COALESCE(SUM(delta.n_delivered_answers), 0)
+     AS n_delivered_answers
+     FROM app LEFT JOIN app_counter_delta AS delta ON delta.app_id=app.id
+     GROUP BY app.id) AS counters'''
+
+
+def fold_app_counters(batch_size=10000):
+    """Add the oldest batch_size changes of app_counter_delta to the
+    counters of their apps, in a single statement.
+
+    Returns the number of changes folded, so it can be called again until it
+    returns 0.
+
+    """
+    sql = text('''WITH folded AS (
+               DELETE FROM app_counter_delta WHERE id IN
+               (SELECT id FROM app_counter_delta ORDER BY id LIMIT :limit)
+               RETURNING *),
+               sums AS (
+               SELECT app_id, COUNT(id) AS n_changes,
+               SUM(n_tasks) AS n_tasks, SUM(n_task_runs) AS n_task_runs,
+               SUM(n_expected_answers) AS n_expected_answers,
+               SUM(n_delivered_answers) AS n_delivered_answers
+               FROM folded GROUP BY app_id),
+               updated AS (
+               UPDATE app SET n_tasks=app.n_tasks + sums.n_tasks,
+               n_task_runs=app.n_task_runs + sums.n_task_runs,
+               n_expected_answers=app.n_expected_answers
+                   + sums.n_expected_answers,
+               n_delivered_answers=app.n_delivered_answers
+                   + sums.n_delivered_answers
+               FROM sums WHERE app.id=sums.app_id)
+               SELECT COALESCE(SUM(n_changes), 0) FROM sums''')
+    return int(db.engine.execute(sql.execution_options(autocommit=True),
+                                 limit=batch_size).scalar())
+
+
+def reset_app_counters(app_id):
+    """Recompute the counters of an app from its tasks and task runs, and
+    drop its changes not folded yet"""
+    sql = text('''LOCK TABLE app_counter_delta IN SHARE ROW EXCLUSIVE MODE;
+               DELETE FROM app_counter_delta WHERE app_id=:app_id;
+               UPDATE app SET
+               n_tasks=(SELECT COUNT(id) FROM task WHERE app_id=:app_id),
+               n_task_runs=(SELECT COUNT(id) FROM task_run
+                            WHERE app_id=:app_id),
+               n_expected_answers=(
+                   SELECT COALESCE(SUM(COALESCE(n_answers, 30)), 0)
+                   FROM task WHERE app_id=:app_id),
+               n_delivered_answers=(
+                   SELECT COALESCE(SUM(LEAST(n_task_runs,
+                                             COALESCE(n_answers, 30))), 0)
+                   FROM task WHERE app_id=:app_id)
+               WHERE id=:app_id''')
+    conn = db.engine.connect()
+    trans = conn.begin()
+    try:
+        conn.execute(sql, app_id=app_id)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+    delete_app_stats(app_id)
+
+
+@memoize(tags=['app:{app_id}'])
 def n_tasks(app_id):
-    sql = text('''SELECT COUNT(task.id) AS n_tasks FROM task
-                  WHERE task.app_id=:app_id''')
-    results = db.engine.execute(sql, app_id=app_id)
-    n_tasks = 0
+    sql = text('''SELECT n_tasks FROM %s WHERE id=:app_id'''
+               % APP_COUNTERS_SQL)
+    return db.engine.execute(sql, app_id=app_id).scalar() or 0
+
+
+@memoize_many(n_tasks)
+def n_tasks_many(app_ids):
+    """Return a dict with the n_tasks of each app"""
+    sql = text('''SELECT id, n_tasks FROM %s WHERE id = ANY(:app_ids)'''
+               % APP_COUNTERS_SQL)
+    results = db.engine.execute(sql, app_ids=app_ids)
+    n_tasks = dict.fromkeys(app_ids, 0)
     for row in results:
-        n_tasks = row.n_tasks
+        n_tasks[row.id] = row.n_tasks
     return n_tasks
 
 
-@memoize()
+@memoize(tags=['app:{app_id}'])
 def n_task_runs(app_id):
-    sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run
-                  WHERE task_run.app_id=:app_id''')
-    results = db.engine.execute(sql, app_id=app_id)
-    n_task_runs = 0
-    for row in results:
-        n_task_runs = row.n_task_runs
-    return n_task_runs
+    sql = text('''SELECT n_task_runs FROM %s WHERE id=:app_id'''
+               % APP_COUNTERS_SQL)
+    return db.engine.execute(sql, app_id=app_id).scalar() or 0
 
 
-@memoize()
+def _progress(n_expected_answers, n_delivered_answers):
+    if not n_expected_answers:
+        return float(0)
+    return float(n_delivered_answers) / float(n_expected_answers) * 100
+
+
+@memoize(tags=['app:{app_id}'])
 def overall_progress(app_id):
     """Returns the percentage of submitted Tasks Runs done when a task is
     completed"""
-    sql = text('''SELECT task.id, n_answers,
-               count(task_run.task_id) AS n_task_runs
-               FROM task LEFT OUTER JOIN task_run ON task.id=task_run.task_id
-               WHERE task.app_id=:app_id GROUP BY task.id''')
-    results = db.engine.execute(sql, app_id=app_id)
-    n_expected_task_runs = 0
-    n_task_runs = 0
+    sql = text('''SELECT n_expected_answers, n_delivered_answers FROM %s
+               WHERE id=:app_id''' % APP_COUNTERS_SQL)
+    for row in db.engine.execute(sql, app_id=app_id):
+        return _progress(row.n_expected_answers, row.n_delivered_answers)
+    return float(0)
+
+
+@memoize_many(overall_progress)
+def overall_progress_many(app_ids):
+    """Return a dict with the overall_progress of each app"""
+    sql = text('''SELECT id, n_expected_answers, n_delivered_answers FROM %s
+               WHERE id = ANY(:app_ids)''' % APP_COUNTERS_SQL)
+    results = db.engine.execute(sql, app_ids=app_ids)
+    progress = dict.fromkeys(app_ids, float(0))
     for row in results:
-        tmp = row[2]
-        if row[2] > row[1]:
-            tmp = row[1]
-        n_expected_task_runs += row[1]
-        n_task_runs += tmp
-    pct = float(0)
-    if n_expected_task_runs != 0:
-        pct = float(n_task_runs) / float(n_expected_task_runs)
-    return (pct * 100)
+        progress[row.id] = _progress(row.n_expected_answers,
+                                     row.n_delivered_answers)
+    return progress
 
 
-@memoize()
+@memoize(tags=['app:{app_id}'])
 def last_activity(app_id):
     sql = text('''SELECT finish_time FROM task_run WHERE app_id=:app_id
                ORDER BY finish_time DESC LIMIT 1''')
@@ -139,8 +234,21 @@ def last_activity(app_id):
             return None
 
 
+@memoize_many(last_activity)
+def last_activity_many(app_ids):
+    """Return a dict with the last_activity of each app"""
+    sql = text('''SELECT app_id, MAX(finish_time) AS finish_time FROM task_run
+               WHERE app_id = ANY(:app_ids) GROUP BY app_id''')
+    results = db.engine.execute(sql, app_ids=app_ids)
+    activity = dict.fromkeys(app_ids)
+    for row in results:
+        activity[row.app_id] = row.finish_time
+    return activity
+
+
 # This function does not change too much, so cache it for a longer time
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="number_featured_apps")
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="number_featured_apps",
+       tags=['featured'])
 def n_featured():
     """Return number of featured apps"""
     sql = text('''select count(*) from featured;''')
@@ -151,7 +259,7 @@ def n_featured():
 
 
 # This function does not change too much, so cache it for a longer time
-@memoize(timeout=STATS_FRONTPAGE_TIMEOUT)
+@memoize(timeout=STATS_FRONTPAGE_TIMEOUT, tags=['featured'])
 def get_featured(category, page=1, per_page=5):
     """Return a list of featured apps with a pagination"""
 
@@ -165,14 +273,16 @@ def get_featured(category, page=1, per_page=5):
                OFFSET(:offset) LIMIT(:limit);
                ''')
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, limit=per_page, offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    created=row.created, description=row.description,
-                   overall_progress=overall_progress(row.id),
-                   last_activity=pretty_date(last_activity(row.id)),
-                   last_activity_raw=last_activity(row.id),
+                   overall_progress=progress[row.id],
+                   last_activity=pretty_date(activity[row.id]),
+                   last_activity_raw=activity[row.id],
                    owner=row.owner,
                    featured=row.id,
                    info=dict(json.loads(row.info)))
@@ -232,7 +342,8 @@ def n_published():
 
 
 # Cache it for longer times, as this is only shown to admin users
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="number_draft_apps")
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="number_draft_apps",
+       tags=['draft'])
 def n_draft():
     """Return number of draft applications"""
     sql = text('''
@@ -247,7 +358,7 @@ def n_draft():
     return count
 
 
-@memoize(timeout=STATS_FRONTPAGE_TIMEOUT)
+@memoize(timeout=STATS_FRONTPAGE_TIMEOUT, tags=['draft'])
 def get_draft(category, page=1, per_page=5):
     """Return list of draft applications"""
 
@@ -264,22 +375,24 @@ def get_draft(category, page=1, per_page=5):
                LIMIT :limit;''')
 
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, limit=per_page, offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    created=row.created,
                    description=row.description,
                    owner=row.owner,
-                   last_activity=pretty_date(last_activity(row.id)),
-                   last_activity_raw=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
+                   last_activity=pretty_date(activity[row.id]),
+                   last_activity_raw=activity[row.id],
+                   overall_progress=progress[row.id],
                    info=dict(json.loads(row.info)))
         apps.append(app)
     return apps, count
 
 
-@memoize()
+@memoize(tags=['category:{category}'])
 def n_count(category):
     """Count the number of apps in a given category"""
     sql = text('''
@@ -302,7 +415,7 @@ def n_count(category):
     return count
 
 
-@memoize()
+@memoize(tags=['category:{category}'])
 def get(category, page=1, per_page=5):
     """Return a list of apps with at least one task and a task_presenter
        with a pagination for a given category"""
@@ -327,7 +440,10 @@ def get(category, page=1, per_page=5):
                LIMIT :limit;''')
 
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, category=category, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, category=category, limit=per_page,
+                                offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id,
@@ -336,9 +452,9 @@ def get(category, page=1, per_page=5):
                    description=row.description,
                    owner=row.owner,
                    featured=row.featured,
-                   last_activity=pretty_date(last_activity(row.id)),
-                   last_activity_raw=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
+                   last_activity=pretty_date(activity[row.id]),
+                   last_activity_raw=activity[row.id],
+                   overall_progress=progress[row.id],
                    info=dict(json.loads(row.info)))
         apps.append(app)
     return apps, count
@@ -347,21 +463,18 @@ def get(category, page=1, per_page=5):
 def reset():
     """Clean the cache"""
     delete_cached("index_front_page")
-    delete_cached('front_page_featured_apps')
     delete_cached('front_page_top_apps')
-    delete_cached('number_featured_apps')
     delete_cached('number_published_apps')
-    delete_cached('number_draft_apps')
     #delete_memoized(get_published)
-    delete_memoized(get_featured)
-    delete_memoized(get_draft)
-    delete_memoized(n_count)
-    delete_memoized(get)
+    sql = text('''SELECT short_name FROM category''')
+    categories = [row.short_name for row in db.engine.execute(sql)]
+    invalidate_tag('featured', 'draft',
+                   *['category:%s' % c for c in categories])
 
 
 def delete_app(short_name):
     """Reset app values in cache"""
-    delete_memoized(get_app, short_name)
+    delete_memoized(get_app_dict, short_name)
 
 
 def delete_n_tasks(app_id):
@@ -384,10 +497,23 @@ def delete_last_activity(app_id):
     delete_memoized(last_activity, app_id)
 
 
-def clean(app_id):
-    """Clean all items in cache"""
-    reset()
-    delete_memoized(n_tasks, app_id)
-    delete_memoized(n_task_runs, app_id)
-    delete_memoized(last_activity, app_id)
-    delete_memoized(overall_progress, app_id)
+def delete_app_stats(app_id):
+    """Reset n_tasks, n_task_runs, overall_progress and last_activity values
+    in cache"""
+    invalidate_tag('app:%s' % app_id)
+
+
+def clean(app_id, category_id=None):
+    """Clean the cached values of an app and of the lists it is shown in"""
+    if category_id is None:
+        sql = text('''SELECT category_id FROM app WHERE id=:app_id''')
+        category_id = db.engine.execute(sql, app_id=app_id).scalar()
+    sql = text('''SELECT short_name FROM category WHERE id=:category_id''')
+    category = db.engine.execute(sql, category_id=category_id).scalar()
+    delete_cached("index_front_page")
+    delete_cached('front_page_top_apps')
+    delete_cached('number_published_apps')
+    tags = ['app:%s' % app_id, 'featured', 'draft']
+    if category:
+        tags.append('category:%s' % category)
+    invalidate_tag(*tags)
@@ -22,10 +22,15 @@ from pybossa.core import db
 import pybossa.model as model
 
 
-@cache(key_prefix="categories_all", timeout=ONE_DAY)
 def get_all():
     """Return all categories"""
-    return db.session.query(model.Category).all()
+    return [model.Category(**c) for c in get_all_dicts()]
+
+
+@cache(key_prefix="categories_all", timeout=ONE_DAY)
+def get_all_dicts():
+    """Return all categories as dicts"""
+    return [c.dictize() for c in db.session.query(model.Category).all()]
 
 
 @cache(key_prefix="categories_used", timeout=ONE_DAY)
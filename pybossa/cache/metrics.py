@@ -0,0 +1,128 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Hit, miss and latency counters for the cached functions.
+
+Every process adds up the counters in memory and adds them to a Redis hash
+per function every few seconds, so recording a call does not cost a Redis
+round trip.
+
+It exports:
+    * CacheMetrics: the counters of the cached functions
+
+"""
+import time
+import logging
+import threading
+from collections import defaultdict
+from redis.exceptions import RedisError
+from pybossa.core import redis_master, redis_slave
+
+log = logging.getLogger(__name__)
+
+# Seconds between two flushes of the counters of a process to Redis
+FLUSH_INTERVAL = 10
+
+
+class CacheMetrics(object):
+    """
+    Counters of the cached functions, by name.
+
+    The counters are hits, local_hits (hits of the in-process cache), misses,
+    compute_ms (time spent computing the missing values), redis_calls,
+    redis_ms (time spent waiting for Redis) and bytes (size of the values
+    read or written).
+
+    """
+
+    def __init__(self, key_prefix, flush_interval=FLUSH_INTERVAL):
+        self.key_prefix = key_prefix
+        self.flush_interval = flush_interval
+        self._counters = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+        self._flushed = time.time()
+
+    def names_key(self):
+        return "%s:metrics" % self.key_prefix
+
+    def key(self, name):
+        return "%s:metrics:%s" % (self.key_prefix, name)
+
+    def record(self, name, **counters):
+        """Add the counters of a call to name."""
+        with self._lock:
+            for counter, value in counters.iteritems():
+                self._counters[name][counter] += value
+            flush = time.time() - self._flushed >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Add the counters of this process to Redis."""
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(
+                lambda: defaultdict(float))
+            self._flushed = time.time()
+        if not counters:
+            return
+        pipe = redis_master.pipeline(transaction=False)
+        for name, values in counters.iteritems():
+            pipe.sadd(self.names_key(), name)
+            for counter, value in values.iteritems():
+                pipe.hincrbyfloat(self.key(name), counter, value)
+        try:
+            pipe.execute()
+        except RedisError as e:  # pragma: no cover
+            log.warning("Cache metrics not flushed: %s" % e)
+
+    def get(self):
+        """Return a dict with the counters of every function, plus its
+        hit_ratio and the mean compute_ms, redis_ms and bytes per call."""
+        self.flush()
+        metrics = {}
+        try:
+            for name in redis_slave.smembers(self.names_key()):
+                values = dict((counter, float(value)) for counter, value
+                              in redis_slave.hgetall(self.key(name)).items())
+                metrics[name] = _summary(values)
+        except RedisError as e:  # pragma: no cover
+            log.warning("Cache metrics not available: %s" % e)
+        return metrics
+
+    def reset(self):
+        """Remove the counters of every function."""
+        with self._lock:
+            self._counters.clear()
+        names = redis_master.smembers(self.names_key())
+        redis_master.delete(self.names_key(),
+                            *[self.key(name) for name in names])
+
+
+def _summary(values):
+    hits = values.get('hits', 0)
+    misses = values.get('misses', 0)
+    calls = hits + misses
+    redis_calls = values.get('redis_calls', 0)
+    summary = dict(values)
+    summary['hit_ratio'] = hits / calls if calls else None
+    summary['mean_compute_ms'] = (values.get('compute_ms', 0) / misses
+                                  if misses else None)
+    summary['mean_redis_ms'] = (values.get('redis_ms', 0) / redis_calls
+                                if redis_calls else None)
+    summary['mean_bytes'] = values.get('bytes', 0) / calls if calls else None
+    return summary
@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Serializers for the cached values.
+
+Values are encoded as JSON, or as msgpack when it is installed, and compressed
+with zlib when they are large. Only plain data (dicts, lists, strings, numbers
+and None) can be cached, so the cached values do not depend on the models.
+
+It exports:
+    * get_serializer: for getting the serializer for a name
+    * JSONSerializer: a serializer for JSON
+    * MsgPackSerializer: a serializer for msgpack
+
+"""
+import json
+import zlib
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+# Increase it when the format of the cached values changes, so the old values
+# are not read any more
+VERSION = 1
+COMPRESS_MIN_SIZE = 1024
+
+# First byte of the serialized values
+RAW = 'r'
+COMPRESSED = 'z'
+
+
+class Serializer(object):
+    """
+    Base class for the serializers.
+
+    Subclasses implement encode and decode, and this class adds the
+    compression of the values larger than compress_min_size bytes.
+
+    """
+
+    name = None
+
+    def __init__(self, compress_min_size=COMPRESS_MIN_SIZE):
+        self.compress_min_size = compress_min_size
+
+    @property
+    def prefix(self):
+        """Prefix for the cache keys with the format of the values."""
+        return "%s%s" % (self.name, VERSION)
+
+    def dumps(self, value):
+        data = self.encode(value)
+        if (self.compress_min_size is not None
+                and len(data) >= self.compress_min_size):
+            return COMPRESSED + zlib.compress(data)
+        return RAW + data
+
+    def loads(self, data):
+        if data[0] == COMPRESSED:
+            return self.decode(zlib.decompress(data[1:]))
+        return self.decode(data[1:])
+
+    def encode(self, value):  # pragma: no cover
+        raise NotImplementedError
+
+    def decode(self, data):  # pragma: no cover
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    name = 'json'
+
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgPackSerializer(Serializer):
+    name = 'msgpack'
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+serializers = dict(json=JSONSerializer, msgpack=MsgPackSerializer)
+
+
+def get_serializer(name='json', compress_min_size=COMPRESS_MIN_SIZE):
+    """Return the serializer for name, or the JSON one if msgpack is not
+    installed."""
+    if name == 'msgpack' and msgpack is None:  # pragma: no cover
+        name = 'json'
+    return serializers[name](compress_min_size)
@@ -153,7 +153,6 @@ def get_rank(team_id):
 
 	return rank, score
 
-@memoize()
 def get_team(name):
     ''' Get Team by name and owner '''
     if current_user.is_anonymous():
@@ -331,8 +330,10 @@ def get_top(n=10):
     results = db.engine.execute(sql, limit=n)
     top_teams = []
     for row in results:
-        print 
-        top_teams.append(row)
+        team = dict(rank=row.rank, score=row.score, name=row.name,
+                    description=row.description, created=row.created,
+                    public=row.public)
+        top_teams.append(team)
     return top_teams
 
 def delete_team_summary():
@@ -32,7 +32,10 @@ def get_top(n=10):
     results = db.engine.execute(sql, limit=n)
     top_users = []
     for row in results:
-        top_users.append(row)
+        user = dict(id=row.id, name=row.name, fullname=row.fullname,
+                    email_addr=row.email_addr, created=row.created,
+                    task_runs=row.task_runs)
+        top_users.append(user)
     return top_users
 
 
@@ -0,0 +1,124 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Warm up of the cache, after a deploy or a Redis failover.
+
+The cached calls of the front page, the stats page, the first pages of every
+category and the counters of the most active apps are computed with a pool of
+processes, so the first visitors do not pay for the cold SQL.
+
+It exports:
+    * get_jobs: for getting the cached calls to warm up
+    * warm: to compute the cached calls with a pool of processes
+
+"""
+import time
+import multiprocessing
+from importlib import import_module
+from sqlalchemy.sql import text
+from pybossa.core import app, db
+
+# Apps per page of the category listings, see view.applications.app_index
+PER_PAGE = 5
+
+FRONT_PAGE = [
+    ('pybossa.cache.apps', 'get_featured_front_page', ()),
+    ('pybossa.cache.apps', 'get_top', ()),
+    ('pybossa.cache.apps', 'n_featured', ()),
+    ('pybossa.cache.apps', 'n_published', ()),
+    ('pybossa.cache.apps', 'n_draft', ()),
+    ('pybossa.cache.users', 'get_top', ()),
+    ('pybossa.cache.teams', 'get_top', ()),
+    ('pybossa.cache.categories', 'get_all_dicts', ()),
+    ('pybossa.cache.categories', 'get_used', ()),
+    ('pybossa.view.stats', 'n_auth_users', ()),
+    ('pybossa.view.stats', 'n_anon_users', ()),
+    ('pybossa.view.stats', 'n_teams', ()),
+    ('pybossa.view.stats', 'n_tasks_site', ()),
+    ('pybossa.view.stats', 'n_total_tasks_site', ()),
+    ('pybossa.view.stats', 'n_task_runs_site', ()),
+    ('pybossa.view.stats', 'get_top5_apps_24_hours', ()),
+    ('pybossa.view.stats', 'get_top5_users_24_hours', ()),
+    ('pybossa.view.stats', 'get_top5_teams_24_hours', ()),
+    ('pybossa.view.stats', 'get_locs', ())]
+
+
+def get_jobs(n_pages=3, n_apps=20):
+    """Return the cached calls to warm up, as (module, function, args).
+
+    They include the front page, the first n_pages of every category, and
+    the counters of the n_apps apps with more task runs.
+
+    """
+    jobs = list(FRONT_PAGE)
+    sql = text('''SELECT short_name FROM category ORDER BY id''')
+    categories = [row.short_name for row in db.engine.execute(sql)]
+    for category in categories:
+        jobs.append(('pybossa.cache.apps', 'n_count', (category,)))
+    for page in range(1, n_pages + 1):
+        jobs.append(('pybossa.cache.apps', 'get_featured',
+                     ('featured', page, PER_PAGE)))
+        jobs.append(('pybossa.cache.apps', 'get_draft',
+                     ('draft', page, PER_PAGE)))
+        for category in categories:
+            jobs.append(('pybossa.cache.apps', 'get',
+                         (category, page, PER_PAGE)))
+
+    sql = text('''SELECT app_id FROM task_run GROUP BY app_id
+               ORDER BY COUNT(id) DESC LIMIT :limit''')
+    app_ids = [row.app_id for row in db.engine.execute(sql, limit=n_apps)]
+    for name in ('n_tasks_many', 'overall_progress_many',
+                 'last_activity_many'):
+        jobs.append(('pybossa.cache.apps', name, (app_ids,)))
+    for app_id in app_ids:
+        jobs.append(('pybossa.cache.apps', 'n_task_runs', (app_id,)))
+    return jobs
+
+
+def warm(jobs, processes=4):
+    """Compute the cached calls with at most processes at the same time.
+
+    Returns a list of (job, seconds, error) with the error message of the
+    failed calls.
+
+    """
+    if processes <= 1:
+        return [run_job(job) for job in jobs]
+    pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    try:
+        return pool.map(run_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_job(job):
+    """Compute a cached call, returning (job, seconds, error)."""
+    module, name, args = job
+    start = time.time()
+    try:
+        with app.test_request_context('/'):
+            getattr(import_module(module), name)(*args)
+    except Exception as e:
+        return job, time.time() - start, str(e)
+    return job, time.time() - start, None
+
+
+def _init_worker():
+    # Do not share the DB connections of the parent process
+    db.engine.dispose()
@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Location of the IPs of the anonymous users, for the stats maps.
+
+The GeoLiteCity database is opened once per process, memory mapped. Every IP
+is looked up in it only once: the resolved locations are stored in the
+ip_location table, and the most used ones are kept in a local LRU.
+
+This module exports:
+    * get_locations: for getting the location of a list of IPs
+
+"""
+import json
+import logging
+import threading
+import pygeoip
+from flask import current_app
+from sqlalchemy.sql import text
+from sqlalchemy.exc import IntegrityError
+from pybossa.core import db
+from pybossa.cache import LocalCache, MISSING, ONE_DAY
+
+log = logging.getLogger(__name__)
+
+LRU_SIZE = 10000
+
+lru = LocalCache(maxsize=LRU_SIZE, timeout=ONE_DAY)
+
+_gic = None
+_gic_lock = threading.Lock()
+
+
+def geolite_path():
+    return current_app.root_path + '/../dat/GeoLiteCity.dat'
+
+
+def _geoip():
+    """Return the GeoLiteCity database, opened once per process"""
+    global _gic
+    if _gic is None:
+        with _gic_lock:
+            if _gic is None:
+                _gic = pygeoip.GeoIP(geolite_path(), pygeoip.MMAP_CACHE)
+    return _gic
+
+
+def _lookup(ip):
+    """Return the location of an IP from the GeoLiteCity database"""
+    try:
+        loc = _geoip().record_by_addr(ip)
+    except Exception as e:  # pragma: no cover
+        log.warning("Location of %s not found: %s" % (ip, e))
+        loc = None
+    if not loc:
+        loc = dict(latitude=0, longitude=0)
+    return loc
+
+
+def get_locations(ips):
+    """Return a dict with the location of each IP.
+
+    The IPs are looked up in the LRU, then in the ip_location table, and only
+    the ones never seen before in the GeoLiteCity database.
+
+    """
+    locs = {}
+    missing = []
+    for ip in set(ips):
+        loc = lru.get(ip)
+        if loc is MISSING:
+            missing.append(ip)
+        else:
+            locs[ip] = loc
+    if not missing:
+        return locs
+
+    sql = text('''SELECT ip, loc FROM ip_location WHERE ip = ANY(:ips)''')
+    for row in db.engine.execute(sql, ips=missing):
+        locs[row.ip] = json.loads(row.loc)
+        lru.set(row.ip, locs[row.ip])
+
+    new = [dict(ip=ip, loc=_lookup(ip)) for ip in missing if ip not in locs]
+    if new:
+        sql = text('''INSERT INTO ip_location (ip, loc) VALUES (:ip, :loc)''')
+        try:
+            db.engine.execute(sql, [dict(ip=item['ip'],
+                                         loc=json.dumps(item['loc']))
+                                    for item in new])
+        except IntegrityError:  # pragma: no cover
+            # Another process stored some of them first
+            log.info("Locations already stored")
+        for item in new:
+            locs[item['ip']] = item['loc']
+            lru.set(item['ip'], item['loc'])
+    return locs
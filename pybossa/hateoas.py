@@ -15,48 +15,55 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
-
-from flask import url_for
+from flask import url_for, request
 
 
 class Hateoas(object):
+    #: Foreign keys of each domain object linked as (rel, key, title)
+    foreign_keys = {'taskrun': [('parent', 'app_id', 'app'),
+                                ('parent', 'task_id', 'task')],
+                    'task': [('parent', 'app_id', 'app')],
+                    'app': [('category', 'category_id', 'category')]}
+
+    def __init__(self):
+        self.templates = {}
+
     def link(self, rel, title, href):
         return "<link rel='%s' title='%s' href='%s'/>" % (rel, title, href)
 
-    def create_link(self, item, rel='self'):
-        title = item.__class__.__name__.lower()
-        method = ".api_%s" % title
-        href = url_for(method, id=item.id, _external=True)
+    def url_template(self, title):
+        """Return the URL of an object of the API with a %s for its id.
+
+        The path is built with url_for once per endpoint, so the links of a
+        list of items do not call url_for for every item, and the host of the
+        request is added to it.
+
+        """
+        if title not in self.templates:
+            path = url_for(".api_%s" % title, id=0)
+            self.templates[title] = path[:-1] + '%s'
+        return request.host_url[:-1] + self.templates[title]
+
+    def create_link(self, title, id, rel='self'):
+        href = self.url_template(title) % id
         return self.link(rel, title, href)
 
     def create_links(self, item):
+        """Return the links to the objects related to the item, and the link
+        to the item. Only the ids of the item are used, so no related object
+        is loaded from the DB."""
         cls = item.__class__.__name__.lower()
-        links = []
-        if cls == 'taskrun':
-            link = self.create_link(item)
-            if item.app_id is not None:
-                links.append(self.create_link(item.app, rel='parent'))
-            if item.task_id is not None:
-                links.append(self.create_link(item.task, rel='parent'))
-            return links, link
-        elif cls == 'task':
-            link = self.create_link(item)
-            if item.app_id is not None:
-                links = [self.create_link(item.app, rel='parent')]
-            return links, link
-        elif cls == 'category':
-            return None, self.create_link(item)
-        elif cls == 'app':
-            link = self.create_link(item)
-            if item.category_id is not None:
-                links.append(self.create_link(item.category, rel='category'))
-            return links, link
-        elif cls == 'user':
-            link = self.create_link(item)
-            # TODO: add the apps created by the user as the links with rel=? (maybe 'app'??)
+        if cls not in ('taskrun', 'task', 'category', 'app', 'user'):
+            return False  # pragma: no cover
+        link = self.create_link(cls, item.id)
+        if cls not in self.foreign_keys:
             return None, link
-        else: # pragma: no cover
-            return False
+        links = []
+        for rel, key, title in self.foreign_keys[cls]:
+            id = getattr(item, key)
+            if id is not None:
+                links.append(self.create_link(title, id, rel=rel))
+        return links, link
 
     def remove_links(self, item):
         """Remove HATEOAS link and links from item"""
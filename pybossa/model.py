@@ -27,7 +27,7 @@ import uuid
 from werkzeug import generate_password_hash, check_password_hash
 import flask.ext.login
 from sqlalchemy import BigInteger, Integer, Boolean, Unicode,\
-        Float, UnicodeText, Text, String
+        Float, UnicodeText, Text, String, Date
 from sqlalchemy.schema import Table, MetaData, Column, ForeignKey
 from sqlalchemy.orm import relationship, backref, class_mapper
 from sqlalchemy.types import MutableType, TypeDecorator
@@ -40,6 +40,8 @@ from sqlalchemy.schema import (
     DropTable,
     ForeignKeyConstraint,
     DropConstraint,
+    DDL,
+    Index,
     )
 
 from pybossa.core import db
@@ -209,6 +211,15 @@ class App(db.Model, DomainObject):
     #:    }
     #:
     info = Column(JSONType, default=dict)
+    #: Counters of the tasks of this app: number of Tasks, number of
+    #: TaskRuns, sum of the n_answers of the tasks and sum of the answers
+    #: delivered, at most n_answers per task. The app_task_counters and
+    #: task_run_count triggers add their changes to app_counter_delta, which
+    #: pybossa.cache.apps.fold_app_counters adds to these columns.
+    n_tasks = Column(Integer, default=0, nullable=False)
+    n_task_runs = Column(Integer, default=0, nullable=False)
+    n_expected_answers = Column(Integer, default=0, nullable=False)
+    n_delivered_answers = Column(Integer, default=0, nullable=False)
 
     ## Relationships
     #: `Task`s for this app.`
@@ -325,6 +336,10 @@ class Task(db.Model, DomainObject):
     info = Column(JSONType, default=dict)
     #: Number of answers or TaskRuns per task
     n_answers = Column(Integer, default=30)
+    #: Number of TaskRuns submitted for this task. It is maintained by the
+    #: task_run_count trigger, which also sets the state of the task to
+    #: completed once n_answers TaskRuns have been submitted.
+    n_task_runs = Column(Integer, default=0, nullable=False)
 
     ## Relationships
     #: `TaskRun`s for this task`
@@ -454,6 +469,208 @@ def empty_string_to_none(mapper, conn, target):
     if target.description == '':
         target.description = None
 
+@event.listens_for(Task, 'before_update')
+@event.listens_for(Task, 'before_insert')
+def n_answers_from_info(mapper, conn, target):
+    # DEPRECATED: target.info.n_answers will be removed
+    # DEPRECATED: use target.n_answers instead
+    if target.info and target.info.get('n_answers'):
+        target.n_answers = int(target.info['n_answers'])
+
+
+# A task is completed once it has enough TaskRuns, so the schedulers never
+# have to write while serving a new task. It is only reopened when it was
+# completed by its counter, so a task closed by its owner stays closed.
+task_state_ddl = DDL('''
+    CREATE OR REPLACE FUNCTION task_state() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.n_task_runs >= COALESCE(NEW.n_answers, 30) THEN
+            NEW.state := 'completed';
+        ELSIF TG_OP = 'UPDATE' AND NEW.state = 'completed'
+              AND OLD.state = 'completed'
+              AND OLD.n_task_runs >= COALESCE(OLD.n_answers, 30) THEN
+            NEW.state := 'ongoing';
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    CREATE TRIGGER task_state BEFORE INSERT OR UPDATE ON task
+    FOR EACH ROW EXECUTE PROCEDURE task_state();
+    ''')
+
+# Partial indexes on the open tasks of an app, used by the schedulers
+task_indexes_ddl = DDL('''
+    CREATE INDEX task_app_id_open_idx ON task (app_id, priority_0 DESC, id)
+    WHERE state != 'completed';
+    CREATE INDEX task_app_id_id_open_idx ON task (app_id, id)
+    WHERE state != 'completed';
+    CREATE INDEX task_app_id_n_task_runs_open_idx
+    ON task (app_id, n_task_runs, id) WHERE state != 'completed';
+    ''')
+
+# Used by the schedulers to skip the tasks already done by a user (or IP)
+Index('task_run_app_id_user_id_idx', TaskRun.__table__.c.app_id,
+      TaskRun.__table__.c.user_id, TaskRun.__table__.c.task_id)
+Index('task_run_app_id_user_ip_idx', TaskRun.__table__.c.app_id,
+      TaskRun.__table__.c.user_ip, TaskRun.__table__.c.task_id)
+
+# Keeps the counter of the task and adds the changes of the app counters to
+# app_counter_delta, so concurrent TaskRuns never wait on the app row. The
+# answers delivered to the app only change while the task is not over its
+# redundancy.
+task_run_count_ddl = DDL('''
+    CREATE OR REPLACE FUNCTION task_run_count() RETURNS trigger AS $$
+    DECLARE
+        runs integer;
+        answers integer;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE task SET n_task_runs = n_task_runs + 1
+            WHERE id = NEW.task_id
+            RETURNING n_task_runs, COALESCE(n_answers, 30)
+            INTO runs, answers;
+            INSERT INTO app_counter_delta
+            (app_id, n_task_runs, n_delivered_answers)
+            VALUES (NEW.app_id, 1,
+                    CASE WHEN runs <= answers THEN 1 ELSE 0 END);
+            RETURN NEW;
+        ELSE
+            UPDATE task SET n_task_runs = n_task_runs - 1
+            WHERE id = OLD.task_id
+            RETURNING n_task_runs, COALESCE(n_answers, 30)
+            INTO runs, answers;
+            INSERT INTO app_counter_delta
+            (app_id, n_task_runs, n_delivered_answers)
+            VALUES (OLD.app_id, -1,
+                    CASE WHEN runs < answers THEN -1 ELSE 0 END);
+            RETURN OLD;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+    CREATE TRIGGER task_run_count AFTER INSERT OR DELETE ON task_run
+    FOR EACH ROW EXECUTE PROCEDURE task_run_count();
+    ''')
+
+# Per app counters, so the progress of an app is read from a single row.
+# Changes of n_task_runs are counted by task_run_count.
+app_task_counters_ddl = DDL('''
+    CREATE OR REPLACE FUNCTION app_task_counters() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO app_counter_delta
+            (app_id, n_tasks, n_expected_answers, n_delivered_answers)
+            VALUES (NEW.app_id, 1, COALESCE(NEW.n_answers, 30),
+                    LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30)));
+            RETURN NEW;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO app_counter_delta
+            (app_id, n_tasks, n_expected_answers, n_delivered_answers)
+            VALUES (OLD.app_id, -1, -COALESCE(OLD.n_answers, 30),
+                    -LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30)));
+            RETURN OLD;
+        ELSE
+            IF NEW.n_answers IS DISTINCT FROM OLD.n_answers THEN
+                INSERT INTO app_counter_delta
+                (app_id, n_expected_answers, n_delivered_answers)
+                VALUES (NEW.app_id,
+                    COALESCE(NEW.n_answers, 30)
+                    - COALESCE(OLD.n_answers, 30),
+                    LEAST(NEW.n_task_runs, COALESCE(NEW.n_answers, 30))
+                    - LEAST(OLD.n_task_runs, COALESCE(OLD.n_answers, 30)));
+            END IF;
+            RETURN NEW;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+    CREATE TRIGGER app_task_counters AFTER INSERT OR UPDATE OR DELETE ON task
+    FOR EACH ROW EXECUTE PROCEDURE app_task_counters();
+    ''')
+
+event.listen(Task.__table__, 'after_create',
+             task_state_ddl.execute_if(dialect='postgresql'))
+event.listen(Task.__table__, 'after_create',
+             app_task_counters_ddl.execute_if(dialect='postgresql'))
+event.listen(Task.__table__, 'after_create',
+             task_indexes_ddl.execute_if(dialect='postgresql'))
+event.listen(TaskRun.__table__, 'after_create',
+             task_run_count_ddl.execute_if(dialect='postgresql'))
+
+
+class AppCounterDelta(db.Model, DomainObject):
+    '''Change of the task counters of an app, added by the triggers and
+    folded into the app row by pybossa.cache.apps.fold_app_counters. There is
+    no foreign key, so inserting a change never locks the app row.
+    '''
+    __tablename__ = 'app_counter_delta'
+    id = Column(Integer, primary_key=True)
+    app_id = Column(Integer, nullable=False, index=True)
+    n_tasks = Column(Integer, server_default='0', nullable=False)
+    n_task_runs = Column(Integer, server_default='0', nullable=False)
+    n_expected_answers = Column(Integer, server_default='0', nullable=False)
+    n_delivered_answers = Column(Integer, server_default='0', nullable=False)
+
+
+class TaskRunDailyRollup(db.Model, DomainObject):
+    '''Number of TaskRuns of an app per day and hour, from anonymous and
+    authenticated users. It is filled by pybossa.stats.update_rollup with the
+    TaskRuns submitted since the last run, so the stats do not have to scan
+    the whole history of an app.
+    '''
+    __tablename__ = 'task_run_daily_rollup'
+    app_id = Column(Integer, ForeignKey('app.id', ondelete='CASCADE'),
+                    primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    hour = Column(Integer, primary_key=True, autoincrement=False)
+    n_anon = Column(Integer, default=0, nullable=False)
+    n_auth = Column(Integer, default=0, nullable=False)
+
+
+class RollupWatermark(db.Model, DomainObject):
+    '''Id of the last row added to a rollup table. The rows up to pending_id
+    are added once every transaction older than pending_txid has ended, so
+    none of them can still be committed.'''
+    __tablename__ = 'rollup_watermark'
+    name = Column(Text, primary_key=True)
+    last_id = Column(Integer, default=0, nullable=False)
+    pending_id = Column(Integer)
+    pending_txid = Column(BigInteger)
+
+
+# TaskRuns deleted after they were rolled up are removed from the rollup.
+# The watermark is locked, so a rollup in progress ends first.
+task_run_rollup_delete_ddl = DDL('''
+    CREATE OR REPLACE FUNCTION task_run_rollup_delete() RETURNS trigger AS $$
+    DECLARE
+        watermark integer;
+    BEGIN
+        SELECT last_id INTO watermark FROM rollup_watermark
+        WHERE name = 'task_run_daily_rollup' FOR SHARE;
+        IF OLD.finish_time IS NOT NULL AND OLD.id <= watermark THEN
+            UPDATE task_run_daily_rollup SET
+            n_anon = n_anon - CASE WHEN OLD.user_id IS NULL THEN 1 ELSE 0 END,
+            n_auth = n_auth - CASE WHEN OLD.user_id IS NULL THEN 0 ELSE 1 END
+            WHERE app_id = OLD.app_id
+            AND day = date_trunc('day', OLD.finish_time::timestamp)::date
+            AND hour = EXTRACT(hour FROM OLD.finish_time::timestamp)::integer;
+        END IF;
+        RETURN OLD;
+    END;
+    $$ LANGUAGE plpgsql;
+    CREATE TRIGGER task_run_rollup_delete AFTER DELETE ON task_run
+    FOR EACH ROW EXECUTE PROCEDURE task_run_rollup_delete();
+    ''')
+
+event.listen(TaskRun.__table__, 'after_create',
+             task_run_rollup_delete_ddl.execute_if(dialect='postgresql'))
+
+
+class IPLocation(db.Model, DomainObject):
+    '''Location of an IP, as found in the GeoLiteCity database'''
+    __tablename__ = 'ip_location'
+    ip = Column(Text, primary_key=True)
+    loc = Column(JSONType, default=dict)
+
+
 class Team(db.Model, DomainObject):
     __tablename__ = 'team'
     id = Column(Integer, primary_key=True)
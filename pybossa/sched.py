@@ -16,184 +16,306 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
-#import json
 #from flask import Blueprint, request, url_for, flash, redirect, abort
 #from flask import abort, request, make_response, current_app
+import json
+from collections import OrderedDict
 from sqlalchemy.sql import text
+from flask.ext.babel import lazy_gettext
 import pybossa.model as model
+import pybossa.sched_queue as sched_queue
+import pybossa.sched_lock as sched_lock
+import pybossa.sched_stats as sched_stats
 from pybossa.core import db
-import random
+
+
+# Registered schedulers: name -> (timed function, description)
+schedulers = OrderedDict()
+
+
+def register_scheduler(name, description=None):
+    '''Register a function returning a list of tasks as the scheduler name.
+
+    The scheduler can then be chosen for an app in its settings, and every call
+    is timed by sched_stats. The function is returned unchanged.
+    '''
+    def decorator(f):
+        schedulers[name] = (sched_stats.timed(name, f), description or name)
+        return f
+    return decorator
 
 
 def new_task(app_id, user_id=None, user_ip=None, offset=0):
     '''Get a new task by calling the appropriate scheduler function.
     '''
+    tasks = new_tasks(app_id, user_id, user_ip, offset=offset, limit=1)
+    return _first(tasks)
+
+
+def new_tasks(app_id, user_id=None, user_ip=None, offset=0, limit=1):
+    '''Get up to limit new tasks with a single call to the appropriate
+    scheduler function.
+
+    The tasks are reserved for the user for the time limit of the app, so
+    concurrent users are not given tasks that already have as many
+    reservations as answers they still need.
+    '''
     app = db.session.query(model.App).get(app_id)
     if not app.allow_anonymous_contributors and user_id is None:
         error = model.Task(info=dict(error="This application does not allow anonymous contributors"))
-        return error
+        return [error]
     else:
-        sched_map = {
-            'default': get_depth_first_task,
-            'breadth_first': get_breadth_first_task,
-            'depth_first': get_depth_first_task,
-            'random': get_random_task,
-            'incremental': get_incremental_task}
-        sched = sched_map.get(app.info.get('sched'), sched_map['default'])
-        return sched(app_id, user_id, user_ip, offset=offset)
+        sched, _ = schedulers.get(app.info.get('sched'),
+                                  schedulers['default'])
+        if not user_id and not user_ip:
+            user_ip = '127.0.0.1'
+        candidates = sched(app_id, user_id, user_ip,
+                           limit=offset + limit + MAX_CANDIDATES)
+        return reserve_tasks(app, candidates, user_id, user_ip,
+                             offset=offset, limit=limit)
+
+
+def reserve_tasks(app, candidates, user_id=None, user_ip=None, offset=0, limit=1):
+    """Return up to limit candidates that can be reserved by the user, after
+    skipping the first offset ones, and reserve them.
+
+    If every candidate is already reserved by other users, the first ones are
+    returned without a reservation, so users always get a task while the app
+    has tasks left.
+    """
+    tasks = []
+    reserved = []
+    available = 0
+    timeout = sched_lock.lock_timeout(app)
+    for task in candidates:
+        if len(tasks) == limit:
+            break
+        if available < offset:
+            ok = sched_lock.is_available(task, user_id, user_ip)
+        else:
+            ok = sched_lock.acquire(task, user_id, user_ip, timeout)
+        if ok:
+            if available >= offset:
+                tasks.append(task)
+            available += 1
+        else:
+            reserved.append(task)
+    if not tasks and offset == 0:
+        return reserved[:limit]
+    return tasks
+
+
+# Number of extra scheduler candidates checked for a free reservation
+MAX_CANDIDATES = 10
 
 
 def get_breadth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Gets a new task which have the least number of task runs (excluding the
+    current user)."""
+    return _first(get_breadth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=offset))
+
+
+@register_scheduler('breadth_first', lazy_gettext('Breadth First'))
+def get_breadth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1):
+    """Gets new tasks which have the least number of task runs (excluding the
     current user).
 
-    Note that it **ignores** the number of answers limit for efficiency reasons
-    (this is not a big issue as all it means is that you may end up with some
-    tasks run more than is strictly needed!)
+    The number of task runs is read from Task.n_task_runs, so the tasks are
+    taken in order from the task_app_id_n_task_runs_open_idx index and the
+    cost does not depend on the number of answers of the app.
     """
-    # Uncomment the next three lines to profile the sched function
-    #import timeit
-    #T = timeit.Timer(lambda: get_candidate_tasks(app_id, user_id,
-    #                  user_ip, n_answers))
-    #print "First algorithm: %s" % T.timeit(number=1)
-
     if user_id and not user_ip:
-        sql = text('''
-                   SELECT task.id, COUNT(task_run.task_id) AS taskcount FROM task
-                   LEFT JOIN task_run ON (task.id = task_run.task_id) WHERE NOT EXISTS
-                   (SELECT 1 FROM task_run WHERE app_id=:app_id AND
-                   user_id=:user_id AND task_id=task.id)
-                   AND task.app_id=:app_id AND task.state !='completed'
-                   group by task.id ORDER BY taskcount, id ASC LIMIT 10;
-                   ''')
-        tasks = db.engine.execute(sql, app_id=app_id, user_id=user_id)
+        query = text(BREADTH_FIRST_TASKS_SQL % dict(
+            user_filter='user_id=:user_id'))
+        rows = db.engine.execute(query, app_id=app_id, user_id=user_id,
+                                 limit=limit, offset=offset)
     else:
         if not user_ip: # pragma: no cover
             user_ip = '127.0.0.1'
-        sql = text('''
-                   SELECT task.id, COUNT(task_run.task_id) AS taskcount FROM task
-                   LEFT JOIN task_run ON (task.id = task_run.task_id) WHERE NOT EXISTS
-                   (SELECT 1 FROM task_run WHERE app_id=:app_id AND
-                   user_ip=:user_ip AND task_id=task.id)
-                   AND task.app_id=:app_id AND task.state !='completed'
-                   group by task.id ORDER BY taskcount, id ASC LIMIT 10;
-                   ''')
-
-        # results will be list of (taskid, count)
-        tasks = db.engine.execute(sql, app_id=app_id, user_ip=user_ip)
-    # ignore n_answers for the present - we will just keep going once we've
-    # done as many as we need
-    tasks = [x[0] for x in tasks]
-    if tasks:
-        if (offset == 0):
-            return db.session.query(model.Task).get(tasks[0])
-        else:
-            if (offset < len(tasks)):
-                return db.session.query(model.Task).get(tasks[offset])
-            else:
-                return None
-    else: # pragma: no cover
-        return None
+        query = text(BREADTH_FIRST_TASKS_SQL % dict(
+            user_filter='user_ip=:user_ip'))
+        rows = db.engine.execute(query, app_id=app_id, user_ip=user_ip,
+                                 limit=limit, offset=offset)
+    return [_task_from_row(row) for row in rows]
+
+
+BREADTH_FIRST_TASKS_SQL = '''
+    SELECT task.id, task.created, task.app_id, task.state, task.quorum,
+    task.calibration, task.priority_0, task.info, task.n_answers,
+    task.n_task_runs
+    FROM task WHERE NOT EXISTS
+    (SELECT task_id FROM task_run WHERE
+    app_id=:app_id AND %(user_filter)s AND task_id=task.id)
+    AND app_id=:app_id AND state !='completed'
+    ORDER BY n_task_runs ASC, id ASC LIMIT :limit OFFSET :offset'''
 
 
 def get_depth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Gets a new task for a given application"""
-    # Uncomment the next three lines to profile the sched function
-    #import timeit
-    #T = timeit.Timer(lambda: get_candidate_tasks(app_id, user_id,
-    #                  user_ip, n_answers))
-    #print "First algorithm: %s" % T.timeit(number=1)
-    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers, offset=offset)
-    total_remaining = len(candidate_tasks)
-    #print "Available tasks %s " % total_remaining
-    if total_remaining == 0:
-        return None
-    if (offset == 0):
-        return candidate_tasks[0]
-    else:
-        if (offset < len(candidate_tasks)):
-            return candidate_tasks[offset]
-        else:
-            return None
+    return _first(get_depth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                        offset=offset))
+
+
+@register_scheduler('default', lazy_gettext('Default'))
+@register_scheduler('depth_first', lazy_gettext('Depth First'))
+def get_depth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1):
+    """Gets new tasks for a given application"""
+    return get_candidate_tasks(app_id, user_id, user_ip, n_answers,
+                               offset=offset, limit=limit)
+
+
+def get_depth_first_queue_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
+    """Gets a new task for a given application from its Redis task queue"""
+    return _first(get_depth_first_queue_tasks(app_id, user_id, user_ip,
+                                              n_answers, offset=offset))
+
+
+@register_scheduler('depth_first_queue', lazy_gettext('Depth First (Redis queue)'))
+def get_depth_first_queue_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1):
+    """Gets new tasks for a given application from its Redis task queue,
+    falling back to the DB when the queue runs dry for the user"""
+    tasks = sched_queue.pop(app_id, user_id, user_ip, offset=offset,
+                            limit=limit)
+    if not tasks:
+        return get_depth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                     offset=offset, limit=limit)
+    return tasks
 
 
 def get_random_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Returns a random task for the user"""
-    app = db.session.query(model.App).get(app_id)
-    from random import choice
-    if len(app.tasks) > 0:
-        return choice(app.tasks)
+    return _first(get_random_tasks(app_id, user_id, user_ip, n_answers,
+                                   offset=offset))
+
+
+@register_scheduler('random', lazy_gettext('Random'))
+def get_random_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1):
+    """Returns random tasks for the user
+
+    A random id between the lowest and the highest id of the open tasks of
+    the app is picked, and the first tasks from that id on not done by the
+    user are returned (wrapping around to the lowest ids). Both lookups use
+    the task_app_id_id_open_idx index, so the tasks of the app are never
+    loaded. Note that tasks after a gap in the ids are slightly more likely.
+    As tasks are random, offset is ignored.
+    """
+    if user_id and not user_ip:
+        query = text(RANDOM_TASK_SQL % dict(user_filter='user_id=:user_id'))
+        rows = db.engine.execute(query, app_id=app_id, user_id=user_id,
+                                 limit=limit)
     else:
-        return None
+        if not user_ip:
+            user_ip = '127.0.0.1'
+        query = text(RANDOM_TASK_SQL % dict(user_filter='user_ip=:user_ip'))
+        rows = db.engine.execute(query, app_id=app_id, user_ip=user_ip,
+                                 limit=limit)
+    return [_task_from_row(row) for row in rows]
+
+
+RANDOM_TASK_SQL = '''
+    WITH pivot AS (
+        SELECT (MIN(id) + floor(random() * (MAX(id) - MIN(id) + 1)))::integer
+        AS id
+        FROM task WHERE app_id=:app_id AND state !='completed')
+    (SELECT task.id, task.created, task.app_id, task.state, task.quorum,
+    task.calibration, task.priority_0, task.info, task.n_answers,
+    task.n_task_runs
+    FROM task WHERE NOT EXISTS
+    (SELECT task_id FROM task_run WHERE
+    app_id=:app_id AND %(user_filter)s AND task_id=task.id)
+    AND app_id=:app_id AND state !='completed'
+    AND id >= (SELECT id FROM pivot)
+    ORDER BY id ASC LIMIT :limit)
+    UNION ALL
+    (SELECT task.id, task.created, task.app_id, task.state, task.quorum,
+    task.calibration, task.priority_0, task.info, task.n_answers,
+    task.n_task_runs
+    FROM task WHERE NOT EXISTS
+    (SELECT task_id FROM task_run WHERE
+    app_id=:app_id AND %(user_filter)s AND task_id=task.id)
+    AND app_id=:app_id AND state !='completed'
+    AND id < (SELECT id FROM pivot)
+    ORDER BY id ASC LIMIT :limit)
+    LIMIT :limit'''
 
 
 def get_incremental_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Get a new task for a given application with its last given answer.
        It is an important strategy when dealing with large tasks, as
        transcriptions"""
-    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers, offset=0)
-    total_remaining = len(candidate_tasks)
-    if total_remaining == 0:
-        return None
-    rand = random.randrange(0, total_remaining)
-    task = candidate_tasks[rand]
-    #Find last answer for the task
-    q = db.session.query(model.TaskRun)\
-          .filter(model.TaskRun.task_id == task.id)\
-          .order_by(model.TaskRun.finish_time.desc())
-    last_task_run = q.first()
-    if last_task_run:
-        task.info['last_answer'] = last_task_run.info
-        #TODO: As discussed in GitHub #53
-        # it is necessary to create a lock in the task!
-    return task
-
-
-def get_candidate_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
-    """Gets all available tasks for a given application and user"""
+    return _first(get_incremental_tasks(app_id, user_id, user_ip, n_answers,
+                                        offset=offset))
+
+
+@register_scheduler('incremental', lazy_gettext('Incremental'))
+def get_incremental_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1):
+    """Get new tasks for a given application with their last given answer."""
+    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=offset, limit=limit)
+    if not candidate_tasks:
+        return candidate_tasks
+    #Find last answer for the tasks
+    sql = text('''SELECT DISTINCT ON (task_id) task_id, info FROM task_run
+               WHERE task_id = ANY(:task_ids)
+               ORDER BY task_id, finish_time DESC''')
+    rows = db.engine.execute(sql, task_ids=[t.id for t in candidate_tasks])
+    last_answers = dict((row.task_id, json.loads(row.info)) for row in rows)
+    for task in candidate_tasks:
+        if task.id in last_answers:
+            task.info['last_answer'] = last_answers[task.id]
+    return candidate_tasks
+
+
+def get_candidate_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=10):
+    """Gets available tasks for a given application and user
+
+    The candidate tasks are fetched with a single query, so no Task or TaskRun
+    ORM objects are loaded. Completed tasks are filtered out by their state,
+    which is maintained when a TaskRun is submitted, so this function never
+    writes to the DB. The returned tasks are built from the rows and are
+    ready to be serialized.
+    """
     rows = None
     if user_id and not user_ip:
-        query = text('''
-                     SELECT id FROM task WHERE NOT EXISTS
-                     (SELECT task_id FROM task_run WHERE
-                     app_id=:app_id AND user_id=:user_id AND task_id=task.id)
-                     AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = db.engine.execute(query, app_id=app_id, user_id=user_id)
+        query = text(CANDIDATE_TASKS_SQL % dict(
+            user_filter='user_id=:user_id'))
+        rows = db.engine.execute(query, app_id=app_id, user_id=user_id,
+                                 limit=limit, offset=offset)
     else:
         if not user_ip:
             user_ip = '127.0.0.1'
-        query = text('''
-                     SELECT id FROM task WHERE NOT EXISTS
-                     (SELECT task_id FROM task_run WHERE
-                     app_id=:app_id AND user_ip=:user_ip AND task_id=task.id)
-                     AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = db.engine.execute(query, app_id=app_id, user_ip=user_ip)
+        query = text(CANDIDATE_TASKS_SQL % dict(
+            user_filter='user_ip=:user_ip'))
+        rows = db.engine.execute(query, app_id=app_id, user_ip=user_ip,
+                                 limit=limit, offset=offset)
+    return [_task_from_row(row) for row in rows]
 
-    tasks = []
-    for t in rows:
-        tasks.append(db.session.query(model.Task).get(t.id))
-
-    candidate_tasks = []
-
-    for t in tasks:
-        # DEPRECATED: t.info.n_answers will be removed
-        # DEPRECATED: so if your task has a different value for n_answers
-        # DEPRECATED: use t.n_answers instead
-        #print t.id
-        if (t.info.get('n_answers')):
-            t.n_answers = int(t.info['n_answers'])
-        # NEW WAY!
-        if t.n_answers is None:  # pragma: no cover
-            t.n_answers = 30
-
-        if (len(t.task_runs) >= t.n_answers):
-                t.state = "completed"
-                db.session.merge(t)
-                db.session.commit()
-        else:
-            candidate_tasks.append(t)
-            if (offset == 0):
-                break
-    return candidate_tasks
+
+# Candidate tasks for a user (or IP). Task.state is set to completed by the
+# task_state trigger, so the open tasks of an app are read from the
+# task_app_id_open_idx partial index.
+CANDIDATE_TASKS_SQL = '''
+    SELECT task.id, task.created, task.app_id, task.state, task.quorum,
+    task.calibration, task.priority_0, task.info, task.n_answers,
+    task.n_task_runs
+    FROM task WHERE NOT EXISTS
+    (SELECT task_id FROM task_run WHERE
+    app_id=:app_id AND %(user_filter)s AND task_id=task.id)
+    AND app_id=:app_id AND state !='completed'
+    ORDER BY priority_0 DESC, id ASC LIMIT :limit OFFSET :offset'''
+
+
+def _task_from_row(row):
+    """Build a Task from a row with the columns of the task table"""
+    return model.Task(id=row.id, created=row.created, app_id=row.app_id,
+                      state=row.state, quorum=row.quorum,
+                      calibration=row.calibration, priority_0=row.priority_0,
+                      info=json.loads(row.info), n_answers=row.n_answers,
+                      n_task_runs=row.n_task_runs)
+
+
+def _first(tasks):
+    if tasks:
+        return tasks[0]
+    return None
@@ -0,0 +1,143 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Time limited task reservations for the scheduler.
+
+Every task has a Redis sorted set with the users (or IPs) that have been given
+the task, scored by the time their reservation expires. A task can be reserved
+by as many users as answers it still needs, and a reservation is released when
+the user submits the TaskRun or when it expires.
+
+This module exports:
+    * acquire: for reserving a task for a user
+    * is_available: to check if a task can be reserved by a user
+    * release: to remove the reservation of a user
+
+"""
+import time
+import logging
+import weakref
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from redis.exceptions import RedisError
+import pybossa.model as model
+from pybossa.core import redis_master
+
+log = logging.getLogger(__name__)
+
+# Used when the app does not define a time_limit for its tasks
+LOCK_TIMEOUT = 10 * 60
+
+# Reservations of the TaskRuns added by each session and not committed yet
+_done = weakref.WeakKeyDictionary()
+
+
+LOCK_SCRIPT = redis_master.register_script('''
+    redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[2])
+    local reserved = redis.call('zscore', KEYS[1], ARGV[1])
+    if not reserved and redis.call('zcard', KEYS[1]) >= tonumber(ARGV[4]) then
+        return 0
+    end
+    if ARGV[5] == '1' then
+        redis.call('zadd', KEYS[1], ARGV[3], ARGV[1])
+        redis.call('expire', KEYS[1], ARGV[6])
+    end
+    return 1''')
+
+
+def lock_key(task_id):
+    return 'sched_lock:%s' % task_id
+
+
+def user_key(user_id=None, user_ip=None):
+    if user_id:
+        return 'user:%s' % user_id
+    return 'ip:%s' % user_ip
+
+
+def lock_timeout(app):
+    """Return the reservation timeout, in seconds, for the tasks of an app"""
+    if app.time_limit:
+        return app.time_limit
+    return LOCK_TIMEOUT
+
+
+def acquire(task, user_id=None, user_ip=None, timeout=LOCK_TIMEOUT):
+    """Reserve a task for a user.
+
+    Returns True if the user already had the task reserved or if the task
+    still needs more answers than the current reservations, False otherwise.
+
+    """
+    return _lock(task, user_id, user_ip, timeout, acquire=True)
+
+
+def is_available(task, user_id=None, user_ip=None):
+    """Return True if the task could be reserved by the user"""
+    return _lock(task, user_id, user_ip, LOCK_TIMEOUT, acquire=False)
+
+
+def release(task_id, user_id=None, user_ip=None):
+    """Remove the reservation of a task for a user"""
+    try:
+        redis_master.zrem(lock_key(task_id), user_key(user_id, user_ip))
+    except RedisError as e:  # pragma: no cover
+        log.warning("Reservation of task %s not released: %s" % (task_id, e))
+
+
+def _lock(task, user_id, user_ip, timeout, acquire):
+    now = time.time()
+    allowed = (task.n_answers or 30) - (task.n_task_runs or 0)
+    args = [user_key(user_id, user_ip), now, now + timeout, allowed,
+            '1' if acquire else '0', int(timeout)]
+    try:
+        return LOCK_SCRIPT(keys=[lock_key(task.id)], args=args) == 1
+    except RedisError as e:  # pragma: no cover
+        # Serve the task without a reservation rather than no task at all
+        log.warning("Reservation of task %s not checked: %s" % (task.id, e))
+        return True
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_task_runs(session, flush_context):
+    """Remember the reservations of the new TaskRuns, they are only released
+    once the transaction is committed"""
+    for obj in session.new:
+        if isinstance(obj, model.TaskRun):
+            _done.setdefault(session, []).append(
+                (obj.task_id, obj.user_id, obj.user_ip))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_task_runs(session):
+    _done.pop(session, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def task_runs_done(session):
+    done = _done.pop(session, None)
+    if not done:
+        return
+    try:
+        pipe = redis_master.pipeline(transaction=False)
+        for task_id, user_id, user_ip in done:
+            pipe.zrem(lock_key(task_id), user_key(user_id, user_ip))
+        pipe.execute()
+    except RedisError as e:  # pragma: no cover
+        log.warning("Reservations of tasks %s not released: %s"
+                    % (sorted(set(tr[0] for tr in done)), e))
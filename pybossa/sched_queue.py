@@ -0,0 +1,235 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Redis task queues for the scheduler.
+
+For every application a sorted set keeps the ids of its open tasks ordered by
+priority_0 and id, and a hash keeps the tasks themselves. For every user (or
+IP) a set keeps the ids of the tasks already done, so a new task can be served
+with a single Redis call. The queues are filled from the DB when they do not
+exist, and they are dropped whenever the tasks of the application change.
+The queues are only updated once the changes are committed.
+
+This module exports:
+    * pop: for getting the next tasks of the queue for a user
+    * delete_queue: to remove the queue of an application
+
+"""
+import json
+import logging
+import weakref
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
+from redis.exceptions import RedisError
+import pybossa.model as model
+from pybossa.core import db, redis_master
+
+log = logging.getLogger(__name__)
+
+QUEUE_SIZE = 100
+QUEUE_TIMEOUT = 10 * 60
+
+# Marks a queue or a done set as loaded from the DB, even if it is empty
+SENTINEL = '0'
+
+# Changes flushed by each session and not committed yet
+_sessions = weakref.WeakKeyDictionary()
+
+
+POP_SCRIPT = redis_master.register_script('''
+    if redis.call('exists', KEYS[1]) == 0 then return 'no_queue' end
+    if redis.call('exists', KEYS[3]) == 0 then return 'no_done' end
+    local skip = tonumber(ARGV[1])
+    local tasks = {}
+    for _, id in ipairs(redis.call('zrange', KEYS[1], 0, -1)) do
+        local done = redis.call('sismember', KEYS[3], tonumber(id))
+        if id ~= ARGV[2] and done == 0 then
+            if skip == 0 then
+                table.insert(tasks, redis.call('hget', KEYS[2], id))
+                if #tasks == tonumber(ARGV[3]) then break end
+            else
+                skip = skip - 1
+            end
+        end
+    end
+    return tasks''')
+
+
+DONE_SCRIPT = redis_master.register_script('''
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call('sadd', KEYS[1], ARGV[1])
+    end
+    return redis.call('exists', KEYS[2])''')
+
+
+def queue_key(app_id):
+    return 'sched_queue:%s' % app_id
+
+
+def tasks_key(app_id):
+    return 'sched_queue:%s:tasks' % app_id
+
+
+def done_key(app_id, user_id=None, user_ip=None):
+    if user_id:
+        return 'sched_queue:%s:done:user:%s' % (app_id, user_id)
+    return 'sched_queue:%s:done:ip:%s' % (app_id, user_ip)
+
+
+def member(task_id):
+    """Zero padded task id, so tasks with the same priority are sorted by
+    id in the queue"""
+    return '%012d' % task_id
+
+
+def pop(app_id, user_id=None, user_ip=None, offset=0, limit=1):
+    """Return the next tasks of the app queue not done by the user.
+
+    Returns an empty list if the user has done every task of the queue, or if
+    Redis is not available, so the caller can fall back to the DB.
+
+    """
+    if not user_id and not user_ip:
+        user_ip = '127.0.0.1'
+    keys = [queue_key(app_id), tasks_key(app_id),
+            done_key(app_id, user_id, user_ip)]
+    try:
+        for i in range(3):
+            out = POP_SCRIPT(keys=keys, args=[offset, SENTINEL, limit])
+            if out == 'no_queue':
+                _fill_queue(app_id)
+            elif out == 'no_done':
+                _fill_done(app_id, user_id, user_ip)
+            else:
+                return [model.Task(**json.loads(task)) for task in out]
+    except RedisError as e:  # pragma: no cover
+        log.warning("Task queue for app %s not available: %s" % (app_id, e))
+    return []
+
+
+def delete_queue(app_id):
+    """Remove the task queue of an app, it will be filled again on demand"""
+    try:
+        redis_master.delete(queue_key(app_id), tasks_key(app_id))
+    except RedisError as e:  # pragma: no cover
+        log.warning("Task queue for app %s not deleted: %s" % (app_id, e))
+
+
+def _fill_queue(app_id):
+    sql = text('''SELECT id, created, app_id, state, quorum, calibration,
+               priority_0, info, n_answers, n_task_runs FROM task
+               WHERE app_id=:app_id AND state !='completed'
+               ORDER BY priority_0 DESC, id ASC LIMIT :limit''')
+    results = db.engine.execute(sql, app_id=app_id, limit=QUEUE_SIZE)
+    zadd = ['ZADD', queue_key(app_id), 'inf', SENTINEL]
+    tasks = {}
+    for row in results:
+        task = dict(id=row.id, created=row.created, app_id=row.app_id,
+                    state=row.state, quorum=row.quorum,
+                    calibration=row.calibration, priority_0=row.priority_0,
+                    info=json.loads(row.info), n_answers=row.n_answers,
+                    n_task_runs=row.n_task_runs)
+        zadd.extend([-row.priority_0, member(row.id)])
+        tasks[member(row.id)] = json.dumps(task)
+    pipe = redis_master.pipeline()
+    pipe.delete(queue_key(app_id), tasks_key(app_id))
+    pipe.execute_command(*zadd)
+    if tasks:
+        pipe.hmset(tasks_key(app_id), tasks)
+        pipe.expire(tasks_key(app_id), QUEUE_TIMEOUT)
+    pipe.expire(queue_key(app_id), QUEUE_TIMEOUT)
+    pipe.execute()
+
+
+def _fill_done(app_id, user_id=None, user_ip=None):
+    if user_id:
+        sql = text('''SELECT task_id FROM task_run WHERE app_id=:app_id
+                   AND user_id=:user_id''')
+        results = db.engine.execute(sql, app_id=app_id, user_id=user_id)
+    else:
+        sql = text('''SELECT task_id FROM task_run WHERE app_id=:app_id
+                   AND user_ip=:user_ip''')
+        results = db.engine.execute(sql, app_id=app_id, user_ip=user_ip)
+    key = done_key(app_id, user_id, user_ip)
+    pipe = redis_master.pipeline()
+    # Plain integers, so Redis keeps small done sets as compact intsets
+    pipe.sadd(key, SENTINEL, *[row.task_id for row in results])
+    pipe.expire(key, QUEUE_TIMEOUT)
+    pipe.execute()
+
+
+def _pending(session):
+    return _sessions.setdefault(session, dict(apps=set(), task_runs=[]))
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_changes(session, flush_context):
+    """Remember the apps with changed tasks and the new TaskRuns, the queues
+    are only updated once the transaction is committed"""
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, model.Task):
+            _pending(session)['apps'].add(obj.app_id)
+        elif isinstance(obj, model.TaskRun) and obj in session.new:
+            _pending(session)['task_runs'].append(
+                (obj.app_id, obj.task_id, obj.user_id, obj.user_ip))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    _sessions.pop(session, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_changes(session):
+    pending = _sessions.pop(session, None)
+    if pending is None:
+        return
+    for app_id in pending['apps']:
+        delete_queue(app_id)
+    task_runs = [tr for tr in pending['task_runs']
+                 if tr[0] not in pending['apps']]
+    if task_runs:
+        _task_runs_done(task_runs)
+
+
+def _task_runs_done(task_runs):
+    """Mark the tasks as done by the users, and remove them from the queues
+    of their apps once they are completed. The state of the tasks is only
+    read for the apps which have a queue."""
+    queued = []
+    try:
+        for app_id, task_id, user_id, user_ip in task_runs:
+            keys = [done_key(app_id, user_id, user_ip), queue_key(app_id)]
+            if DONE_SCRIPT(keys=keys, args=[task_id]) == 1:
+                queued.append((app_id, task_id))
+        if not queued:
+            return
+        sql = text('''SELECT id FROM task WHERE id = ANY(:task_ids)
+                   AND state='completed' ''')
+        results = db.engine.execute(
+            sql, task_ids=[task_id for _, task_id in queued])
+        completed = set(row.id for row in results)
+        pipe = redis_master.pipeline()
+        for app_id, task_id in queued:
+            if task_id in completed:
+                pipe.zrem(queue_key(app_id), member(task_id))
+                pipe.hdel(tasks_key(app_id), member(task_id))
+        pipe.execute()
+    except RedisError as e:  # pragma: no cover
+        log.warning("Task queues not updated: %s" % e)
@@ -0,0 +1,132 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Latency and DB query metrics for the schedulers.
+
+Every call to a registered scheduler increments a Redis hash with the number
+of calls, the total time, the number of DB queries and a latency histogram,
+so the percentiles of the different strategies can be compared on live
+traffic.
+
+This module exports:
+    * timed: to wrap a scheduler function with the metrics
+    * get_stats: for getting the metrics of a scheduler
+    * reset_stats: to remove the metrics of a scheduler
+
+"""
+import time
+import logging
+import threading
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from redis.exceptions import RedisError
+from pybossa.core import redis_master, redis_slave
+
+log = logging.getLogger(__name__)
+
+# Upper bounds, in ms, of the latency histogram buckets
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+_queries = threading.local()
+
+
+def stats_key(name):
+    return 'sched_stats:%s' % name
+
+
+def bucket(elapsed):
+    """Return the histogram field for a latency in ms"""
+    for upper in BUCKETS:
+        if elapsed <= upper:
+            return 'le_%s' % upper
+    return 'le_inf'
+
+
+def timed(name, f):
+    """Wrap a scheduler function so every call is recorded under name"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_queries, 'depth', 0)
+        if depth == 0:
+            _queries.count = 0
+        _queries.depth = depth + 1
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _queries.depth = depth
+            if depth == 0:
+                _record(name, (time.time() - start) * 1000, _queries.count)
+    return wrapper
+
+
+def get_stats(name):
+    """Return the number of calls, the mean number of DB queries and the mean
+    and p50/p95/p99 latencies, in ms, of a scheduler"""
+    try:
+        data = redis_slave.hgetall(stats_key(name))
+    except RedisError as e:  # pragma: no cover
+        log.warning("Stats for scheduler %s not available: %s" % (name, e))
+        data = {}
+    calls = int(data.get('calls', 0))
+    stats = dict(calls=calls, time_ms=None, queries=None,
+                 p50=None, p95=None, p99=None)
+    if calls:
+        stats['time_ms'] = float(data['time_ms']) / calls
+        stats['queries'] = float(data.get('queries', 0)) / calls
+        for p in (50, 95, 99):
+            stats['p%s' % p] = _percentile(data, calls, p)
+    return stats
+
+
+def reset_stats(name):
+    """Remove the metrics of a scheduler"""
+    try:
+        redis_master.delete(stats_key(name))
+    except RedisError as e:  # pragma: no cover
+        log.warning("Stats for scheduler %s not reset: %s" % (name, e))
+
+
+def _percentile(data, calls, p):
+    """Upper bound of the histogram bucket holding the p percentile, or None
+    if it is above the last bucket"""
+    seen = 0
+    for upper in BUCKETS:
+        seen += int(data.get('le_%s' % upper, 0))
+        if seen * 100 >= calls * p:
+            return upper
+    return None
+
+
+def _record(name, elapsed, queries):
+    pipe = redis_master.pipeline(transaction=False)
+    pipe.hincrby(stats_key(name), 'calls', 1)
+    pipe.hincrbyfloat(stats_key(name), 'time_ms', elapsed)
+    pipe.hincrby(stats_key(name), 'queries', queries)
+    pipe.hincrby(stats_key(name), bucket(elapsed), 1)
+    try:
+        pipe.execute()
+    except RedisError as e:  # pragma: no cover
+        log.warning("Stats for scheduler %s not recorded: %s" % (name, e))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_queries, 'depth', 0):
+        _queries.count += 1
@@ -17,25 +17,184 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
-from pybossa.core import db
+from redis.exceptions import RedisError
+from pybossa.core import db, redis_master, redis_slave
 from pybossa.cache import cache, memoize, ONE_DAY
 from pybossa.model import TaskRun, Task
 from pybossa.cache import FIVE_MINUTES, memoize
+import pybossa.geo
 
-import string
-import pygeoip
+import logging
 import operator
+import weakref
 import datetime
 import time
 from datetime import timedelta
 
+log = logging.getLogger(__name__)
 
-@memoize(timeout=ONE_DAY)
-def get_task_runs(app_id):
-    """Return all the Task Runs for a given app_id"""
-    task_runs = db.session.query(TaskRun).filter_by(app_id=app_id).all()
-    return task_runs
+# Apps changed by each session and not committed yet
+_changed_apps = weakref.WeakKeyDictionary()
+
+
+def version_key(app_id):
+    return 'stats_version:%s' % app_id
+
+
+def data_version(app_id):
+    """Return the version of the answers and tasks of an app, which changes
+    whenever one of them is added, changed or deleted"""
+    try:
+        return redis_slave.get(version_key(app_id)) or '0'
+    except RedisError as e:  # pragma: no cover
+        log.warning("Stats version of app %s not available: %s" % (app_id, e))
+        return '0'
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_changes(session, flush_context):
+    """Remember the apps whose answers or tasks changed, their version is
+    bumped once the transaction is committed"""
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (Task, TaskRun)):
+            _changed_apps.setdefault(session, set()).add(obj.app_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    _changed_apps.pop(session, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def stats_changed(session):
+    app_ids = _changed_apps.pop(session, None)
+    if app_ids:
+        bump_data_version(*app_ids)
+
+
+def bump_data_version(*app_ids):
+    """Change the version of the data of the apps, for the writers that do
+    not go through the session, like a raw UPDATE of their tasks"""
+    try:
+        pipe = redis_master.pipeline(transaction=False)
+        for app_id in app_ids:
+            pipe.incr(version_key(app_id))
+        pipe.execute()
+    except RedisError as e:  # pragma: no cover
+        log.warning("Stats version of apps %s not updated: %s"
+                    % (sorted(app_ids), e))
+
+
+def stats_key(app_id, *args, **kwargs):
+    """Memoize key of the stats formatters: the app and the version of its
+    data, instead of the (large) stats they are given"""
+    return '%s:%s' % (app_id, data_version(app_id))
+
+
+def stats_users_key(app_id, users, anon_users, auth_users, geo=False):
+    return '%s:%s' % (stats_key(app_id), geo)
+
+
+ROLLUP_BATCH_SIZE = 100000
+ROLLUP = 'task_run_daily_rollup'
+
+# Answers per app, day and hour: the rollup plus the TaskRuns submitted since
+# its last update. Filter it by app_id or day to use the indexes.
+ANSWERS_SQL = '''
+    (SELECT app_id, day, hour, n_anon, n_auth FROM task_run_daily_rollup
+     UNION ALL
+     SELECT app_id, date_trunc('day', finish_time::timestamp)::date AS day,
+     EXTRACT(hour FROM finish_time::timestamp)::integer AS hour,
+     COUNT(id) - COUNT(user_id) AS n_anon, COUNT(user_id) AS n_auth
+     FROM task_run WHERE finish_time IS NOT NULL
+     AND id > (SELECT COALESCE(MAX(last_id), 0) FROM rollup_watermark
+               WHERE name='task_run_daily_rollup')
+     GROUP BY app_id, day, hour) AS answers'''
+
+
+def update_rollup(batch_size=ROLLUP_BATCH_SIZE):
+    """Add the TaskRuns submitted since the last run to the
+    task_run_daily_rollup table, at most batch_size ids at a time.
+
+    A TaskRun id is taken before its transaction commits, so ids are only
+    added once every transaction that was running when they were handed out
+    has ended: each run adds the ids recorded as pending by a previous one,
+    and records the ids handed out since then as pending.
+
+    Returns the number of ids processed, so it can be called again until it
+    returns 0.
+
+    """
+    conn = db.engine.connect()
+    trans = conn.begin()
+    try:
+        # Lock the watermark, so only one job updates the rollup at a time
+        sql = text('''SELECT last_id, pending_id, pending_txid
+                   FROM rollup_watermark WHERE name=:name FOR UPDATE''')
+        watermark = conn.execute(sql, name=ROLLUP).first()
+        if watermark is None:
+            sql = text('''INSERT INTO rollup_watermark (name, last_id)
+                       VALUES (:name, 0)''')
+            conn.execute(sql, name=ROLLUP)
+            last_id, pending_id, pending_txid = 0, None, None
+        else:
+            last_id, pending_id, pending_txid = watermark
+        sql = text('''SELECT txid_snapshot_xmin(txid_current_snapshot())''')
+        oldest_txid = conn.execute(sql).scalar()
+        if pending_txid is not None and oldest_txid < pending_txid:
+            # Some ids may still be committed
+            trans.rollback()
+            return 0
+        max_id = min(pending_id or 0, last_id + batch_size)
+        if max_id <= last_id:
+            sql = text('''UPDATE rollup_watermark SET
+                       pending_id=(SELECT last_value FROM task_run_id_seq),
+                       pending_txid=txid_snapshot_xmax(txid_current_snapshot())
+                       WHERE name=:name''')
+            conn.execute(sql, name=ROLLUP)
+            trans.commit()
+            return 0
+        sql = text('''SELECT app_id,
+                   date_trunc('day', finish_time::timestamp)::date AS day,
+                   EXTRACT(hour FROM finish_time::timestamp)::integer AS hour,
+                   COUNT(id) - COUNT(user_id) AS n_anon,
+                   COUNT(user_id) AS n_auth FROM task_run
+                   WHERE id > :last_id AND id <= :max_id
+                   AND finish_time IS NOT NULL
+                   GROUP BY app_id, day, hour''')
+        rows = conn.execute(sql, last_id=last_id, max_id=max_id).fetchall()
+        update = text('''UPDATE task_run_daily_rollup
+                      SET n_anon=n_anon + :n_anon, n_auth=n_auth + :n_auth
+                      WHERE app_id=:app_id AND day=:day AND hour=:hour''')
+        insert = text('''INSERT INTO task_run_daily_rollup
+                      (app_id, day, hour, n_anon, n_auth)
+                      VALUES (:app_id, :day, :hour, :n_anon, :n_auth)''')
+        for row in rows:
+            params = dict(app_id=row.app_id, day=row.day, hour=row.hour,
+                          n_anon=row.n_anon, n_auth=row.n_auth)
+            if conn.execute(update, **params).rowcount == 0:
+                conn.execute(insert, **params)
+        sql = text('''UPDATE rollup_watermark SET last_id=:max_id
+                   WHERE name=:name''')
+        conn.execute(sql, max_id=max_id, name=ROLLUP)
+        trans.commit()
+        return max_id - last_id
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def delete_rollup(app_id):
+    """Remove the rollup rows of an app, once all its TaskRuns are deleted.
+    Deleted TaskRuns are already subtracted from the rollup by the
+    task_run_rollup_delete trigger."""
+    sql = text('''DELETE FROM task_run_daily_rollup WHERE app_id=:app_id''')
+    db.engine.execute(sql, app_id=app_id)
 
 
 #@memoize(timeout=ONE_DAY)
@@ -114,55 +273,38 @@ def stats_users(app_id):
 
 @memoize(timeout=ONE_DAY)
 def stats_dates(app_id):
+    """Return the number of answers per day, in total, from anonymous and
+    from authenticated users, read from the rollup"""
     dates = {}
     dates_anon = {}
     dates_auth = {}
     dates_n_tasks = {}
 
-    task_runs = get_task_runs(app_id)
-
     avg, total_n_tasks = get_avg_n_tasks(app_id)
 
-    for tr in task_runs:
-        # Data for dates
-        date, hour = string.split(tr.finish_time, "T")
-        tr.finish_time = string.split(tr.finish_time, '.')[0]
-        hour = string.split(hour, ":")[0]
-
-        # Dates
-        if date in dates.keys():
-            dates[date] += 1
-        else:
-            dates[date] = 1
-
-        if date in dates_n_tasks.keys():
-            dates_n_tasks[date] = total_n_tasks * avg
-        else:
-            dates_n_tasks[date] = total_n_tasks * avg
-
-        if tr.user_id is None:
-            if date in dates_anon.keys():
-                dates_anon[date] += 1
-            else:
-                dates_anon[date] = 1
-        else:
-            if date in dates_auth.keys():
-                dates_auth[date] += 1
-            else:
-                dates_auth[date] = 1
+    sql = text('''SELECT day, SUM(n_anon + n_auth) AS n_answers,
+               SUM(n_auth) AS n_auth FROM %s
+               WHERE app_id=:app_id GROUP BY day''' % ANSWERS_SQL)
+    results = db.engine.execute(sql, app_id=app_id)
+    for row in results:
+        date = row.day.strftime('%Y-%m-%d')
+        n_answers, n_auth = int(row.n_answers), int(row.n_auth)
+        dates[date] = n_answers
+        dates_n_tasks[date] = total_n_tasks * avg
+        if n_answers > n_auth:
+            dates_anon[date] = n_answers - n_auth
+        if n_auth:
+            dates_auth[date] = n_auth
     return dates, dates_n_tasks, dates_anon, dates_auth
 
 
 @memoize(timeout=ONE_DAY)
 def stats_hours(app_id):
+    """Return the number of answers per hour of the day, in total, from
+    anonymous and from authenticated users, read from the rollup"""
     hours = {}
     hours_anon = {}
     hours_auth = {}
-    max_hours = 0
-    max_hours_anon = 0
-    max_hours_auth = 0
-
-    task_runs = get_task_runs(app_id)
 
     # initialize hours keys
     for i in range(0, 24):
@@ -170,32 +312,29 @@ def stats_hours(app_id):
         hours_anon[str(i).zfill(2)] = 0
         hours_auth[str(i).zfill(2)] = 0
 
-    for tr in task_runs:
-        # Hours
-        date, hour = string.split(tr.finish_time, "T")
-        tr.finish_time = string.split(tr.finish_time, '.')[0]
-        hour = string.split(hour, ":")[0]
+    sql = text('''SELECT hour, SUM(n_anon + n_auth) AS n_answers,
+               SUM(n_auth) AS n_auth FROM %s
+               WHERE app_id=:app_id GROUP BY hour''' % ANSWERS_SQL)
+    results = db.engine.execute(sql, app_id=app_id)
+    for row in results:
+        hour = str(row.hour).zfill(2)
+        hours[hour] = int(row.n_answers)
+        hours_anon[hour] = int(row.n_answers) - int(row.n_auth)
+        hours_auth[hour] = int(row.n_auth)
+    max_hours = max(hours.values())
+    max_hours_anon = max(hours_anon.values())
+    max_hours_auth = max(hours_auth.values())
+    return hours, hours_anon, hours_auth, max_hours, max_hours_anon, max_hours_auth
 
-        if hour in hours.keys():
-            hours[hour] += 1
-            if (hours[hour] > max_hours):
-                max_hours = hours[hour]
 
-        if tr.user_id is None:
-            if hour in hours_anon.keys():
-                hours_anon[hour] += 1
-                if (hours_anon[hour] > max_hours_anon):
-                    max_hours_anon = hours_anon[hour]
-
-        else:
-            if hour in hours_auth.keys():
-                hours_auth[hour] += 1
-                if (hours_auth[hour] > max_hours_auth):
-                    max_hours_auth = hours_auth[hour]
-    return hours, hours_anon, hours_auth, max_hours, max_hours_anon, max_hours_auth
+def date_to_ms(date):
+    """Return a YYYY-MM-DD date as miliseconds since EPOCH, for JavaScript"""
+    year, month, day = date.split('-')
+    date = datetime.date(int(year), int(month), int(day))
+    return int(time.mktime(date.timetuple()) * 1000)
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, key_builder=stats_key)
 def stats_format_dates(app_id, dates, dates_n_tasks, dates_estimate,
                        dates_anon, dates_auth):
     """Format dates stats into a JSON format"""
@@ -206,95 +345,62 @@ def stats_format_dates(app_id, dates, dates_n_tasks, dates_estimate,
     dayNewAnonStats = dict(label="Anonymous", values=[])
     dayNewAuthStats = dict(label="Authenticated", values=[])
 
+    # A single pass over the sorted dates, converting each one only once
     total = 0
-    for d in sorted(dates.keys()):
-        # JavaScript expects miliseconds since EPOCH
+    for d in sorted(dates):
+        ms = date_to_ms(d)
+        total = total + dates[d]
         # New answers per day
-        dayNewStats['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), dates[d]])
-
-        dayAvgAnswers['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-             dates_n_tasks[d]])
-
+        dayNewStats['values'].append([ms, dates[d]])
+        dayAvgAnswers['values'].append([ms, dates_n_tasks[d]])
         # Total answers per day
-        total = total + dates[d]
-        dayTotalStats['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), total])
-
-        # Anonymous answers per day
-        if d in (dates_anon.keys()):
-            dayNewAnonStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-                 dates_anon[d]])
-        else: # pragma: no cover
-            dayNewAnonStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), 0])
-
-        # Authenticated answers per day
-        if d in (dates_auth.keys()):
-            dayNewAuthStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-                 dates_auth[d]])
-        else: # pragma: no cover
-            dayNewAuthStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), 0])
-
-    for d in sorted(dates_estimate.keys()):
-        dayEstimates['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-             dates_estimate[d]])
-
-        dayAvgAnswers['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-             dates_n_tasks.values()[0]])
+        dayTotalStats['values'].append([ms, total])
+        # Anonymous and authenticated answers per day
+        dayNewAnonStats['values'].append([ms, dates_anon.get(d, 0)])
+        dayNewAuthStats['values'].append([ms, dates_auth.get(d, 0)])
+
+    if dates_estimate:
+        n_expected = dates_n_tasks.values()[0]
+    for d in sorted(dates_estimate):
+        ms = date_to_ms(d)
+        dayEstimates['values'].append([ms, dates_estimate[d]])
+        dayAvgAnswers['values'].append([ms, n_expected])
 
     return dayNewStats, dayNewAnonStats, dayNewAuthStats, \
         dayTotalStats, dayAvgAnswers, dayEstimates
 
 
-@memoize(timeout=ONE_DAY)
+def _hour_value(hour, n_answers, max_hours):
+    """Return the [hour, answers, bubble size] of an hour"""
+    if n_answers != 0:
+        return [int(hour), n_answers, (n_answers * 5) / max_hours]
+    return [int(hour), n_answers, 0]
+
+
+@memoize(timeout=ONE_DAY, key_builder=stats_key)
 def stats_format_hours(app_id, hours, hours_anon, hours_auth,
                        max_hours, max_hours_anon, max_hours_auth):
     """Format hours stats into a JSON format"""
-    hourNewStats = dict(label="Anon + Auth", disabled="True", values=[], max=0)
-    hourNewAnonStats = dict(label="Anonymous", values=[], max=0)
-    hourNewAuthStats = dict(label="Authenticated", values=[], max=0)
+    hourNewStats = dict(label="Anon + Auth", disabled="True", values=[],
+                        max=max_hours)
+    hourNewAnonStats = dict(label="Anonymous", values=[], max=max_hours_anon)
+    hourNewAuthStats = dict(label="Authenticated", values=[],
+                            max=max_hours_auth)
 
-    hourNewStats['max'] = max_hours
-    hourNewAnonStats['max'] = max_hours_anon
-    hourNewAuthStats['max'] = max_hours_auth
-
-    for h in sorted(hours.keys()):
+    for h in sorted(hours):
         # New answers per hour
-        #hourNewStats['values'].append(dict(x=int(h), y=hours[h], size=hours[h]*10))
-        if (hours[h] != 0):
-            hourNewStats['values'].append([int(h), hours[h],
-                                           (hours[h] * 5) / max_hours])
-        else:
-            hourNewStats['values'].append([int(h), hours[h], 0])
-
-        # New Anonymous answers per hour
-        if h in hours_anon.keys():
-            #hourNewAnonStats['values'].append(dict(x=int(h), y=hours[h], size=hours_anon[h]*10))
-            if (hours_anon[h] != 0):
-                hourNewAnonStats['values'].append([int(h), hours_anon[h],
-                                                   (hours_anon[h] * 5) / max_hours])
-            else:
-                hourNewAnonStats['values'].append([int(h), hours_anon[h], 0])
-
-        # New Authenticated answers per hour
-        if h in hours_auth.keys():
-            #hourNewAuthStats['values'].append(dict(x=int(h), y=hours[h], size=hours_auth[h]*10))
-            if (hours_auth[h] != 0):
-                hourNewAuthStats['values'].append([int(h), hours_auth[h],
-                                                   (hours_auth[h] * 5) / max_hours])
-            else:
-                hourNewAuthStats['values'].append([int(h), hours_auth[h], 0])
+        hourNewStats['values'].append(_hour_value(h, hours[h], max_hours))
+        # New Anonymous and Authenticated answers per hour
+        if h in hours_anon:
+            hourNewAnonStats['values'].append(
+                _hour_value(h, hours_anon[h], max_hours))
+        if h in hours_auth:
+            hourNewAuthStats['values'].append(
+                _hour_value(h, hours_auth[h], max_hours))
     return hourNewStats, hourNewAnonStats, hourNewAuthStats
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, key_builder=stats_users_key)
 def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
     """Format User Stats into JSON"""
     userStats = dict(label="User Statistics", values=[])
@@ -311,35 +417,13 @@ def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
         userAuthStats['values'].append(dict(label=u[0], value=[u[1]]))
 
     # Get location for Anonymous users
-    top5_anon = []
     top5_auth = []
     loc_anon = []
-    # Check if the GeoLiteCity.dat exists
-    geolite = current_app.root_path + '/../dat/GeoLiteCity.dat'
+    locs = {}
     if geo: # pragma: no cover
-        gic = pygeoip.GeoIP(geolite)
+        locs = pybossa.geo.get_locations([u[0] for u in anon_users])
     for u in anon_users:
-        if geo: # pragma: no cover
-            loc = gic.record_by_addr(u[0])
-        else:
-            loc = {}
-        if loc is None: # pragma: no cover
-            loc = {}
-        if (len(loc.keys()) == 0):
-            loc['latitude'] = 0
-            loc['longitude'] = 0
-        top5_anon.append(dict(ip=u[0], loc=loc, tasks=u[1]))
-
-    for u in anon_users:
-        if geo: # pragma: no cover
-            loc = gic.record_by_addr(u[0])
-        else:
-            loc = {}
-        if loc is None: # pragma: no cover
-            loc = {}
-        if (len(loc.keys()) == 0):
-            loc['latitude'] = 0
-            loc['longitude'] = 0
+        loc = locs.get(u[0]) or dict(latitude=0, longitude=0)
         loc_anon.append(dict(ip=u[0], loc=loc, tasks=u[1]))
 
     for u in auth_users:
@@ -350,7 +434,7 @@ def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
             name = row.name
         top5_auth.append(dict(name=name, fullname=fullname, tasks=u[1]))
 
-    userAnonStats['top5'] = top5_anon[0:5]
+    userAnonStats['top5'] = loc_anon[0:5]
     userAnonStats['locs'] = loc_anon
     userAuthStats['top5'] = top5_auth
 
@@ -18,6 +18,7 @@
 
 from flask import Blueprint
 from flask import render_template
+from flask import render_template_string
 from flask import request
 from flask import abort
 from flask import flash
@@ -35,6 +36,7 @@ from pybossa.core import db
 from pybossa.util import admin_required
 from pybossa.cache import apps as cached_apps
 from pybossa.cache import categories as cached_cat
+from pybossa.cache import get_metrics
 from pybossa.auth import require
 import pybossa.validator as pb_validator
 from sqlalchemy import or_, func
@@ -59,6 +61,55 @@ def index():
     return render_template('/admin/index.html')
 
 
+# The themes do not ship a page for the cache metrics
+CACHE_METRICS_TEMPLATE = u'''{% extends "/base.html" %}
+{% block content %}
+<div class="container">
+  <h1>{{ _('Cache metrics') }}</h1>
+  {% if metrics %}
+  <table class="table table-striped">
+    <tr>
+      <th>{{ _('Function') }}</th><th>{{ _('Hits') }}</th>
+      <th>{{ _('Misses') }}</th><th>{{ _('Hit ratio') }}</th>
+      <th>{{ _('Compute (ms)') }}</th><th>{{ _('Redis (ms)') }}</th>
+      <th>{{ _('Size (bytes)') }}</th>
+    </tr>
+    {% for name, m in metrics %}
+    <tr>
+      <td>{{ name }}</td><td>{{ m.hits|int }}</td><td>{{ m.misses|int }}</td>
+      <td>{{ '%.2f'|format(m.hit_ratio) if m.hit_ratio is not none }}</td>
+      <td>{{ '%.1f'|format(m.mean_compute_ms)
+             if m.mean_compute_ms is not none }}</td>
+      <td>{{ '%.1f'|format(m.mean_redis_ms) if m.mean_redis_ms is not none }}</td>
+      <td>{{ m.mean_bytes|int if m.mean_bytes is not none }}</td>
+    </tr>
+    {% endfor %}
+  </table>
+  {% else %}
+  <p>{{ _('No cached function has been called yet') }}</p>
+  {% endif %}
+  <a href="{{ url_for('admin.cache_metrics_json') }}">JSON</a>
+</div>
+{% endblock %}'''
+
+
+@blueprint.route('/cache')
+@login_required
+@admin_required
+def cache_metrics():
+    """Show the hit, miss and latency counters of the cached functions"""
+    metrics = sorted(get_metrics().items())
+    return render_template_string(CACHE_METRICS_TEMPLATE, metrics=metrics)
+
+
+@blueprint.route('/cache.json')
+@login_required
+@admin_required
+def cache_metrics_json():
+    """Return the counters of the cached functions in JSON"""
+    return Response(json.dumps(get_metrics()), mimetype='application/json')
+
+
 @blueprint.route('/featured')
 @blueprint.route('/featured/<int:app_id>', methods=['POST', 'DELETE'])
 @login_required
@@ -81,7 +132,7 @@ def featured(app_id=None):
             app = db.session.query(model.App).get(app_id)
             if app:
                 if request.method == 'POST':
-                    cached_apps.reset()
+                    cached_apps.clean(app.id)
                     f = model.Featured()
                     f.app_id = app_id
                     require.app.update(app)
@@ -97,7 +148,7 @@ def featured(app_id=None):
                         msg = "App.id %s alreay in Featured table" % app_id
                         return format_error(msg, 415)
                 if request.method == 'DELETE':
-                    cached_apps.reset()
+                    cached_apps.clean(app.id)
                     f = db.session.query(model.Featured)\
                           .filter(model.Featured.app_id == app_id)\
                           .first()
@@ -27,6 +27,8 @@ from werkzeug.exceptions import HTTPException
 from sqlalchemy.sql import text
 
 import pybossa.model as model
+from pybossa.sched import schedulers
+import pybossa.sched_queue as sched_queue
 import pybossa.stats as stats
 import pybossa.validator as pb_validator
 
@@ -103,11 +105,14 @@ class TaskPriorityForm(Form):
 
 
 class TaskSchedulerForm(Form):
-    sched = SelectField(lazy_gettext('Task Scheduler'),
-                        choices=[('default', lazy_gettext('Default')),
-                                 ('breadth_first', lazy_gettext('Breadth First')),
-                                 ('depth_first', lazy_gettext('Depth First')),
-                                 ('random', lazy_gettext('Random'))],)
+    sched = SelectField(lazy_gettext('Task Scheduler'))
+
+    def __init__(self, *args, **kwargs):
+        super(TaskSchedulerForm, self).__init__(*args, **kwargs)
+        choices = [(name, description) for name, (_, description)
+                   in schedulers.items()]
+        # Keep the default scheduler on top, whatever the registration order
+        self.sched.choices = sorted(choices, key=lambda c: c[0] != 'default')
 
 
 def app_title(app, page_name):
@@ -175,10 +180,11 @@ def app_index(page, lookup, category, fallback, use_count):
 
     apps, count = lookup(category, page, per_page)
 
+    n_tasks = cached_apps.n_tasks_many([app['id'] for app in apps])
     data = []
     for app in apps:
-        data.append(dict(app=app, n_tasks=cached_apps.n_tasks(app['id']),
-                         overall_progress=cached_apps.overall_progress(app['id']),
+        data.append(dict(app=app, n_tasks=n_tasks[app['id']],
+                         overall_progress=app['overall_progress'],
                          last_activity=app['last_activity'],
                          last_activity_raw=app['last_activity_raw']))
 
@@ -620,10 +626,7 @@ def _import_task(app, handler, form, render_forms):
         if n == 1:
             msg = str(n) + " " + gettext('Task imported successfully!')
         flash(msg, 'success')
-        cached_apps.delete_n_tasks(app.id)
-        cached_apps.delete_n_task_runs(app.id)
-        cached_apps.delete_overall_progress(app.id)
-        cached_apps.delete_last_activity(app.id)
+        cached_apps.delete_app_stats(app.id)
         return redirect(url_for('.tasks', short_name=app.short_name))
     except importer.BulkImportException, err_msg:
         flash(err_msg, 'error')
@@ -858,10 +861,8 @@ def delete_tasks(short_name):
             db.session.commit()
             msg = gettext("All the tasks and associated task runs have been deleted")
             flash(msg, 'success')
-            cached_apps.delete_last_activity(app.id)
-            cached_apps.delete_n_tasks(app.id)
-            cached_apps.delete_n_task_runs(app.id)
-            cached_apps.delete_overall_progress(app.id)
+            cached_apps.delete_app_stats(app.id)
+            stats.delete_rollup(app.id)
             return redirect(url_for('.tasks', short_name=app.short_name))
     except HTTPException:
         return abort(403)
@@ -1147,6 +1148,9 @@ def task_n_answers(short_name):
                        UPDATE task SET n_answers=:n_answers,
                        state='ongoing' WHERE app_id=:app_id''')
             db.engine.execute(sql, n_answers=form.n_answers.data, app_id=app.id)
+            # The raw UPDATE is not seen by the session events
+            sched_queue.delete_queue(app.id)
+            stats.bump_data_version(app.id)
             msg = gettext('Redundancy of Tasks updated!')
             flash(msg, 'success')
             return redirect(url_for('.tasks', short_name=app.short_name))
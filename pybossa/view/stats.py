@@ -16,7 +16,6 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 import json
-import pygeoip
 from flask import Blueprint, current_app
 from flask import render_template
 from sqlalchemy.sql import text
@@ -24,6 +23,8 @@ from sqlalchemy.sql import text
 from pybossa.core import db
 from pybossa.cache import cache, ONE_DAY, ONE_HOUR
 from pybossa.cache import apps as cached_apps
+from pybossa.stats import ANSWERS_SQL
+from pybossa import geo
 
 blueprint = Blueprint('stats', __name__)
 
@@ -69,35 +70,43 @@ def n_total_tasks_site():
     results = db.engine.execute(sql)
     for row in results:
         total = row.n_tasks
-    return total
+    # SUM returns a Decimal, which cannot be cached
+    return int(total or 0)
 
 
 @cache(timeout=ONE_DAY, key_prefix="site_n_task_runs")
 def n_task_runs_site():
-    sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run''')
+    # The app counters include the task runs without a finish_time too
+    sql = text('''SELECT SUM(n_task_runs) AS n_task_runs FROM %s'''
+               % cached_apps.APP_COUNTERS_SQL)
     results = db.engine.execute(sql)
     for row in results:
         n_task_runs = row.n_task_runs
-    return n_task_runs
+    # SUM returns a Decimal, which cannot be cached
+    return int(n_task_runs or 0)
 
 
 @cache(timeout=ONE_DAY, key_prefix="site_top5_apps_24_hours")
 def get_top5_apps_24_hours():
     # Top 5 Most active apps in last 24 hours
     sql = text('''SELECT app.id, app.name, app.short_name, app.info,
-               COUNT(task_run.app_id) AS n_answers FROM app, task_run
-               WHERE app.id=task_run.app_id
+               SUM(answers.n_anon + answers.n_auth) AS n_answers
+               FROM app, %s
+               WHERE app.id=answers.app_id
                AND app.hidden=0
-               AND DATE(task_run.finish_time) > NOW() - INTERVAL '24 hour'
-               AND DATE(task_run.finish_time) <= NOW()
+               AND answers.day
+                   >= DATE(timezone('UTC', NOW()) - INTERVAL '24 hour')
+               AND answers.day + answers.hour * INTERVAL '1 hour'
+                   > timezone('UTC', NOW()) - INTERVAL '24 hour'
                GROUP BY app.id
-               ORDER BY n_answers DESC LIMIT 5;''')
+               ORDER BY n_answers DESC LIMIT 5;''' % ANSWERS_SQL)
 
     results = db.engine.execute(sql, limit=5)
     top5_apps_24_hours = []
     for row in results:
         tmp = dict(id=row.id, name=row.name, short_name=row.short_name,
-                   info=dict(json.loads(row.info)), n_answers=row.n_answers)
+                   info=dict(json.loads(row.info)),
+                   n_answers=int(row.n_answers))
         top5_apps_24_hours.append(tmp)
     return top5_apps_24_hours
 
@@ -157,17 +166,8 @@ def get_locs(): # pragma: no cover
     locs = []
     if current_app.config['GEO']:
         sql = '''SELECT DISTINCT(user_ip) from task_run WHERE user_ip IS NOT NULL;'''
-        results = db.engine.execute(sql)
-
-        geolite = current_app.root_path + '/../dat/GeoLiteCity.dat'
-        gic = pygeoip.GeoIP(geolite)
-        for row in results:
-            loc = gic.record_by_addr(row.user_ip)
-            if loc is None:
-                loc = {}
-            if (len(loc.keys()) == 0):
-                loc['latitude'] = 0
-                loc['longitude'] = 0
+        ips = [row.user_ip for row in db.engine.execute(sql)]
+        for loc in geo.get_locations(ips).itervalues():
             locs.append(dict(loc=loc))
     return locs
 
@@ -581,3 +581,23 @@ class TestAdmin(web.Helper):
         assert category['name'] in res.data, err_msg
         output = db.session.query(model.Category).get(obj.id)
         assert output.id == category['id'], err_msg
+
+    def test_23_admin_cache_metrics(self):
+        """Test ADMIN cache metrics are only shown to admins"""
+        self.register()
+        res = self.app.get('/admin/cache.json')
+        err_msg = "Admins should get the cache metrics in JSON"
+        assert res.status_code == 200, err_msg
+        assert isinstance(json.loads(res.data), dict), err_msg
+        res = self.app.get('/admin/cache')
+        err_msg = "Admins should get the cache metrics page"
+        assert res.status_code == 200, err_msg
+        assert "Cache metrics" in res.data, err_msg
+        self.signout()
+        self.register(username="tester2", email="tester2@tester.com",
+                      password="tester")
+        res = self.app.get('/admin/cache.json')
+        err_msg = "Other users should not get the cache metrics"
+        assert res.status_code == 403, err_msg
+        res = self.app.get('/admin/cache')
+        assert res.status_code == 403, err_msg
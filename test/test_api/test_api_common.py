@@ -81,6 +81,89 @@ class TestApiCommon(HelperAPI):
         assert data[0].get('name') == 'user7', data
 
 
+    def test_01_cursor_query(self):
+        """Test API GET pages with a cursor or a last_id work"""
+        for i in range(30):
+            task = model.Task(app_id=1, info=dict(a=i))
+            db.session.add(task)
+        db.session.commit()
+        ids = [t.id for t in db.session.query(model.Task).filter_by(app_id=1)
+               .order_by(model.Task.id).all()]
+
+        res = self.app.get('/api/task?app_id=1&limit=10&last_id=%s' % ids[4])
+        data = json.loads(res.data)
+        assert [t['id'] for t in data] == ids[5:15], data
+
+        seen = []
+        url = '/api/task?app_id=1&limit=10'
+        while url:
+            res = self.app.get(url)
+            seen.extend(t['id'] for t in json.loads(res.data))
+            link = res.headers.get('Link')
+            url = None
+            if link:
+                url = link[1:link.index('>')]
+                assert 'cursor=' in url and 'app_id=1' in url, url
+        assert seen == ids, seen
+
+        res = self.app.get('/api/task?cursor=wrong')
+        err = json.loads(res.data)
+        assert res.status_code == 415, res.data
+        assert err['exception_cls'] == 'ValueError', err
+
+
+    @patch('pybossa.api.api_base.CHUNK_SIZE', 2)
+    def test_02_streamed_query(self):
+        """Test API GET lists are written in chunks"""
+        res = self.app.get('/api/task?limit=5')
+        data = json.loads(res.data)
+        assert len(data) == 5, data
+        assert [t['id'] for t in data] == sorted(t['id'] for t in data), data
+
+        res = self.app.get('/api/task?limit=5', buffered=False)
+        chunks = list(res.response)
+        err_msg = "The items should be written two at a time"
+        assert len(chunks) == 3, chunks
+        assert json.loads(''.join(chunks)) == data, err_msg
+
+        res = self.app.get('/api/task?limit=0')
+        err = json.loads(res.data)
+        assert res.status_code == 415, res.data
+        assert err['exception_cls'] == 'ValueError', err
+
+        res = self.app.get('/api/task?app_id=100000')
+        assert json.loads(res.data) == [], res.data
+
+        res = self.app.get('/api/task?app_id=wrong')
+        err = json.loads(res.data)
+        assert res.status_code == 415, res.data
+        assert err['exception_cls'] == 'DataError', err
+
+
+    def test_03_fields_query(self):
+        """Test API GET returns only the requested fields"""
+        res = self.app.get('/api/taskrun?fields=id,task_id,user_id')
+        data = json.loads(res.data)
+        assert len(data) > 0, data
+        for taskrun in data:
+            assert sorted(taskrun.keys()) == ['id', 'link', 'links',
+                                              'task_id', 'user_id'], taskrun
+
+        res = self.app.get('/api/task/1?fields=info&links=0')
+        data = json.loads(res.data)
+        assert data.keys() == ['info'], data
+
+        res = self.app.get('/api/user?fields=name,locale')
+        data = json.loads(res.data)
+        for user in data:
+            assert sorted(user.keys()) == ['locale', 'name'], user
+
+        res = self.app.get('/api/task?fields=id,wrong')
+        err = json.loads(res.data)
+        assert res.status_code == 415, res.data
+        assert err['exception_cls'] == 'AttributeError', err
+
+
     def test_get_query_with_api_key(self):
         """ Test API GET query with an API-KEY"""
         for endpoint in self.endpoints:
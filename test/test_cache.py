@@ -16,8 +16,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import hashlib
-from pybossa.cache import get_key_to_hash, get_hash_key
+from mock import patch
+from pybossa.cache import get_key_to_hash, get_hash_key, LocalCache, \
+    must_refresh, MISSING, get_tags, memoize, get_memoize_key, \
+    get_version_key, local_cache, TAG_SCRIPT
+from pybossa.cache.serializer import JSONSerializer, COMPRESSED, RAW
+from pybossa.cache import apps as cached_apps
+from pybossa.cache import warm
+from base import web, model, db, Fixtures, redis_flushall, redis_master
 
 
 class TestCache():
@@ -51,3 +59,214 @@ class TestCache():
         key = get_hash_key(prefix, key_to_hash)
         err_msg = "The expected key is different %s != %s" % (expected, key)
         assert expected == key, err_msg
+
+    def test_04_local_cache(self):
+        """Test CACHE LocalCache evicts the least recently used values."""
+        local = LocalCache(maxsize=2, timeout=10)
+        local.set('a', 1)
+        local.set('b', None)
+        assert local.get('a') == 1, "The value should be cached"
+        local.set('c', 3)
+        err_msg = "The least recently used value should be evicted"
+        assert local.get('b') is MISSING, err_msg
+        assert local.get('a') == 1, err_msg
+        assert local.get('c') == 3, err_msg
+
+        local.set('a', 1, timeout=-1)
+        err_msg = "Expired values should not be returned"
+        assert local.get('a') is MISSING, err_msg
+
+    def test_05_must_refresh(self):
+        """Test CACHE must_refresh only refreshes values close to expiry."""
+        now = time.time()
+        err_msg = "A fresh value should not be refreshed"
+        assert not must_refresh(0.01, now + 3600, now), err_msg
+        err_msg = "An expired value should be refreshed"
+        assert must_refresh(0.01, now - 1, now), err_msg
+
+    def test_06_get_tags(self):
+        """Test CACHE get_tags formats the tags with the call arguments."""
+        def f(category, page=1, per_page=5):
+            return category
+
+        tags = get_tags(['category:{category}', 'page:{page}'], f, 'featured')
+        expected = ['category:featured', 'page:1']
+        err_msg = "Different tags %s != %s" % (tags, expected)
+        assert tags == expected, err_msg
+        tags = get_tags(['category:{category}'], f, category=u'ñ', page=2)
+        assert tags == [u'category:ñ'], tags
+        assert get_tags(None, f, 'featured') == [], "There should be no tags"
+
+    def test_07_serializer(self):
+        """Test CACHE serializer compresses only large values."""
+        serializer = JSONSerializer(compress_min_size=100)
+        value = [dict(id=1, name=u'ñ'), 2, None]
+        data = serializer.dumps(value)
+        assert data[0] == RAW, "Small values should not be compressed"
+        assert serializer.loads(data) == value, serializer.loads(data)
+
+        value = dict(info='x' * 1000)
+        data = serializer.dumps(value)
+        assert data[0] == COMPRESSED, "Large values should be compressed"
+        assert len(data) < 100, "The value should be compressed"
+        assert serializer.loads(data) == value, serializer.loads(data)
+        assert serializer.prefix.startswith('json'), serializer.prefix
+
+    @patch('pybossa.cache.get_key_prefix', return_value='prefix')
+    def test_08_memoize_key_builder(self, get_key_prefix):
+        """Test CACHE memoize key_builder replaces the hash of the args."""
+        @memoize(key_builder=lambda app_id, stats: 'v%s' % app_id)
+        def format_stats(app_id, stats):
+            return stats
+
+        @memoize()
+        def n_stats(app_id):
+            return app_id
+
+        key = get_memoize_key(format_stats, 1, dict(a=range(1000)))
+        assert key == 'prefix:format_stats_args::v1', key
+        key = get_memoize_key(n_stats, 1)
+        expected = get_hash_key('prefix:n_stats_args:', ':1')
+        assert key == expected, key
+
+    @patch('pybossa.cache.get_key_prefix', return_value='prefix')
+    def test_09_memoize_version(self, get_key_prefix):
+        """Test CACHE memoize keys change with the function version."""
+        redis_flushall()
+        local_cache.clear()
+
+        @memoize()
+        def n_stats(app_id):
+            return app_id
+
+        key = get_memoize_key(n_stats, 1)
+        redis_master.incr(get_version_key(n_stats))
+        err_msg = "The version should be kept in the local cache"
+        assert get_memoize_key(n_stats, 1) == key, err_msg
+        local_cache.clear()
+        new_key = get_memoize_key(n_stats, 1)
+        assert new_key != key, "A new version should change the keys"
+        expected = get_hash_key('prefix:n_stats_args:1', ':1')
+        assert new_key == expected, new_key
+
+    def test_10_tag_prune(self):
+        """Test CACHE tag sets drop the expired keys every N added keys."""
+        redis_flushall()
+        keys = ['tag', 'tag:adds']
+        for i in range(3):
+            redis_master.set('key:%s' % i, 1)
+            TAG_SCRIPT(keys=keys, args=['key:%s' % i, 60, 4])
+        redis_master.delete('key:0', 'key:1')
+        assert redis_master.scard('tag') == 3, "Tag sets are not pruned yet"
+        redis_master.set('key:3', 1)
+        TAG_SCRIPT(keys=keys, args=['key:3', 60, 4])
+        members = redis_master.smembers('tag')
+        assert members == set(['key:2', 'key:3']), members
+        redis_master.delete('key:2')
+        for i in range(4, 7):
+            redis_master.set('key:%s' % i, 1)
+            TAG_SCRIPT(keys=keys, args=['key:%s' % i, 60, 4])
+        err_msg = "Tag sets should not be pruned again until 4 more adds"
+        assert 'key:2' in redis_master.smembers('tag'), err_msg
+        TAG_SCRIPT(keys=keys, args=['key:3', 60, 4])
+        assert 'key:2' in redis_master.smembers('tag'), err_msg
+        redis_master.set('key:7', 1)
+        TAG_SCRIPT(keys=keys, args=['key:7', 60, 4])
+        assert 'key:2' not in redis_master.smembers('tag'), err_msg
+        assert redis_master.ttl('tag:adds') > 0, "The counter should expire"
+
+
+class TestCachedApps:
+    def setUp(self):
+        self.app = web.app
+        model.rebuild_db()
+        Fixtures.create()
+
+    def tearDown(self):
+        db.session.remove()
+
+    @classmethod
+    def teardown_class(cls):
+        model.rebuild_db()
+        redis_flushall()
+
+    def test_00_many(self):
+        """Test CACHE batch app helpers return the same as the single ones."""
+        app_ids = [1, 1, 2]
+        with self.app.test_request_context('/'):
+            for single, many in [
+                    (cached_apps.n_tasks, cached_apps.n_tasks_many),
+                    (cached_apps.overall_progress,
+                     cached_apps.overall_progress_many),
+                    (cached_apps.last_activity,
+                     cached_apps.last_activity_many)]:
+                values = many(app_ids)
+                expected = dict((i, single(i)) for i in app_ids)
+                err_msg = "%s: %s != %s" % (many.__name__, values, expected)
+                assert values == expected, err_msg
+            assert cached_apps.n_tasks_many([]) == {}, "No apps, no values"
+
+    def test_01_warm(self):
+        """Test CACHE warm up computes every cached call."""
+        category = db.session.query(model.Category).first()
+        jobs = warm.get_jobs(n_pages=2, n_apps=5)
+        job = ('pybossa.cache.apps', 'get', (category.short_name, 2, 5))
+        assert job in jobs, "The category pages should be warmed up"
+        job = ('pybossa.cache.apps', 'n_tasks_many', ([1],))
+        assert job in jobs, "The counters of the top apps should be warmed up"
+
+        results = warm.warm(jobs, processes=1)
+        errors = [(job, error) for job, seconds, error in results if error]
+        assert len(results) == len(jobs), results
+        assert errors == [], errors
+
+    def test_02_counters(self):
+        """Test CACHE app counters follow the tasks and task runs."""
+        def check():
+            sql = '''SELECT COUNT(task.id), SUM(n_answers),
+                  SUM(LEAST(n_task_runs, n_answers)) FROM task
+                  WHERE app_id=1'''
+            n_tasks, expected, delivered = db.engine.execute(sql).first()
+            sql = 'SELECT COUNT(id) FROM task_run WHERE app_id=1'
+            n_task_runs = db.engine.execute(sql).scalar()
+            sql = 'SELECT * FROM %s WHERE id=1' % cached_apps.APP_COUNTERS_SQL
+            app = db.engine.execute(sql).first()
+            assert app.n_tasks == n_tasks, (app.n_tasks, n_tasks)
+            assert app.n_task_runs == n_task_runs, (app.n_task_runs,
+                                                    n_task_runs)
+            assert app.n_expected_answers == expected
+            assert app.n_delivered_answers == delivered
+            assert cached_apps.n_tasks(1) == n_tasks
+            assert cached_apps.n_task_runs(1) == n_task_runs
+
+        check()
+        task = db.session.query(model.Task).filter_by(app_id=1).first()
+        task.n_answers = 1
+        db.session.commit()
+        check()
+        for i in range(2):
+            db.session.add(model.TaskRun(app_id=1, task_id=task.id,
+                                         user_ip='10.0.0.%s' % i))
+            db.session.commit()
+            check()
+        db.session.delete(db.session.query(model.TaskRun).first())
+        db.session.commit()
+        check()
+        db.session.delete(db.session.query(model.Task).get(task.id))
+        db.session.commit()
+        check()
+
+        # The changes are folded into the app row
+        assert cached_apps.fold_app_counters(batch_size=2) == 2
+        check()
+        assert cached_apps.fold_app_counters() > 0
+        assert cached_apps.fold_app_counters() == 0
+        check()
+        n_changes = db.session.query(model.AppCounterDelta).count()
+        assert n_changes == 0, n_changes
+
+        # The counters can be recomputed from scratch
+        db.engine.execute('''UPDATE app SET n_task_runs=0,
+                          n_delivered_answers=0 WHERE id=1''')
+        cached_apps.reset_app_counters(1)
+        check()
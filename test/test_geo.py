@@ -0,0 +1,61 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+from mock import patch
+from base import web, model, db, redis_flushall
+from pybossa import geo
+
+
+class TestGeo:
+    def setUp(self):
+        self.app = web.app
+        model.rebuild_db()
+        geo.lru.clear()
+
+    def tearDown(self):
+        db.session.remove()
+
+    @classmethod
+    def teardown_class(cls):
+        model.rebuild_db()
+        redis_flushall()
+
+    @patch('pybossa.geo._lookup')
+    def test_00_get_locations(self, lookup):
+        """Test GEO every IP is looked up only once"""
+        lookup.side_effect = lambda ip: dict(latitude=1, longitude=2, ip=ip)
+        ips = ['127.0.0.1', '127.0.0.2', '127.0.0.1']
+        with self.app.test_request_context('/'):
+            locs = geo.get_locations(ips)
+            assert locs['127.0.0.1'] == dict(latitude=1, longitude=2,
+                                             ip='127.0.0.1'), locs
+            assert len(locs) == 2, locs
+            assert lookup.call_count == 2, lookup.call_count
+
+            # From the LRU
+            assert geo.get_locations(ips) == locs
+            assert lookup.call_count == 2, lookup.call_count
+
+            # From the DB
+            geo.lru.clear()
+            assert geo.get_locations(ips) == locs
+            assert lookup.call_count == 2, lookup.call_count
+            assert db.session.query(model.IPLocation).count() == 2
+
+            locs = geo.get_locations(['127.0.0.3'])
+            assert locs.keys() == ['127.0.0.3'], locs
+            assert lookup.call_count == 3, lookup.call_count
@@ -18,7 +18,7 @@
 
 import json
 
-from base import Fixtures
+from base import web, model, Fixtures
 from helper import web as web_helper
 from pybossa.hateoas import Hateoas
 
@@ -208,3 +208,41 @@ class TestHateoas(web_helper.Helper):
         # # when the links specification of a user will be set, modify the following
         # err_msg = "The list of links should be empty for now"
         # assert output.get('links') == None, err_msg
+
+    def test_02_links_from_ids(self):
+        """Test HATEOAS links are built from the ids of the item"""
+        taskrun = model.TaskRun(id=5, app_id=3, task_id=7)
+        with web.app.test_request_context('/api/taskrun'):
+            links, link = self.hateoas.create_links(taskrun)
+        assert link == self.hateoas.link(
+            rel='self', title='taskrun', href='http://localhost/api/taskrun/5')
+        assert links == [
+            self.hateoas.link(rel='parent', title='app',
+                              href='http://localhost/api/app/3'),
+            self.hateoas.link(rel='parent', title='task',
+                              href='http://localhost/api/task/7')], links
+
+    def test_03_no_links(self):
+        """Test HATEOAS links are not added with links=0"""
+        for endpoint in ['app', 'task', 'taskrun', 'category']:
+            res = self.app.get("/api/%s?links=0" % endpoint)
+            output = json.loads(res.data)[0]
+            assert 'link' not in output, output
+            assert 'links' not in output, output
+            res = self.app.get("/api/%s/1?links=0" % endpoint)
+            output = json.loads(res.data)
+            assert 'link' not in output, output
+
+    def test_04_link_object_host(self):
+        """Test HATEOAS object link uses the host of each request"""
+        for host in ('example.com', 'example.org'):
+            res = self.app.get("/api/app/1", base_url='http://%s' % host)
+            output = json.loads(res.data)
+            app_link = self.hateoas.link(rel='self', title='app',
+                                         href='http://%s/api/app/1' % host)
+            err_msg = "The object link is wrong: %s" % output['link']
+            assert app_link == output['link'], err_msg
+        from pybossa.api.api_base import APIBase
+        err_msg = "There should be one template per endpoint, not per host"
+        titles = set(['app', 'task', 'taskrun', 'category', 'user'])
+        assert set(APIBase.hateoas.templates) <= titles, err_msg
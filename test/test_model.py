@@ -19,6 +19,7 @@
 from base import model, db, redis_flushall
 from nose.tools import raises, assert_raises
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import text
 
 
 class TestModel:
@@ -292,6 +293,51 @@ class TestModel:
         user = model.User.by_name(username)
         assert user.apps[0].id == app_id, user
 
+    def test_task_state(self):
+        """Test TASK state is completed when it has enough task runs"""
+        user = model.User(name=u'johndoe', fullname=u'John Doe',
+                          email_addr=u'john.doe@example.com')
+        app = model.App(name=u'Application', short_name=u'app',
+                        description=u'desc')
+        app.owner = user
+        task = model.Task(n_answers=2)
+        task.app = app
+        db.session.add_all([user, app, task])
+        db.session.commit()
+        task_id = task.id
+
+        for i in range(2):
+            task_run = model.TaskRun(app_id=app.id, task_id=task_id,
+                                     user_ip='127.0.0.%s' % i)
+            db.session.add(task_run)
+            db.session.commit()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.n_task_runs == 2, task.n_task_runs
+        assert task.state == 'completed', task.state
+
+        db.session.query(model.TaskRun).filter_by(task_id=task_id).delete()
+        db.session.commit()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.n_task_runs == 0, task.n_task_runs
+        assert task.state == 'ongoing', task.state
+
+        task.state = 'completed'
+        db.session.commit()
+        db.session.add(model.TaskRun(app_id=app.id, task_id=task_id,
+                                     user_ip='127.0.0.3'))
+        db.session.commit()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.n_task_runs == 1, task.n_task_runs
+        err_msg = "A task closed by its owner should stay closed"
+        assert task.state == 'completed', err_msg
+
+    def test_task_open_index(self):
+        """Test TASK open index matches the scheduler ORDER BY"""
+        sql = text("""SELECT indexdef FROM pg_indexes
+                   WHERE indexname = 'task_app_id_open_idx'""")
+        indexdef = db.engine.execute(sql).scalar()
+        assert '(app_id, priority_0 DESC, id)' in indexdef, indexdef
+
 #    def test_user(self):
 #        """Test MODEL User works"""
 #        user = model.User(name=u'test-user', email_addr=u'test@xyz.org')
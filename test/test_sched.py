@@ -22,6 +22,7 @@ import random
 from helper import sched
 from base import model, Fixtures, db, redis_flushall
 import pybossa
+from sqlalchemy import text
 
 
 class TestSched(sched.Helper):
@@ -351,6 +352,27 @@ class TestSched(sched.Helper):
         print json.loads(res.data)
         assert json.loads(res.data) == {}, res.data
 
+    def test_task_preloading_limit(self):
+        """Test TASK Pre-loading with a limit returns a list of tasks"""
+        redis_flushall()
+        # Del previous TaskRuns
+        self.del_task_runs()
+
+        res = self.app.get('api/app/1/newtask?limit=5')
+        tasks = json.loads(res.data)
+        err_msg = "There should be 5 different tasks"
+        assert len(tasks) == 5, err_msg
+        assert len(set([t['id'] for t in tasks])) == 5, err_msg
+        # The first task is the one returned without a limit
+        res = self.app.get('api/app/1/newtask')
+        task = json.loads(res.data)
+        assert task['id'] == tasks[0]['id'], task
+
+        res = self.app.get('api/app/1/newtask?limit=5&offset=8')
+        tasks = json.loads(res.data)
+        err_msg = "There are only 10 tasks"
+        assert len(tasks) == 2, err_msg
+
     def test_task_priority(self):
         """Test SCHED respects priority_0 field"""
         redis_flushall()
@@ -386,6 +408,29 @@ class TestSched(sched.Helper):
         assert task1.get('priority_0') == 1, err_msg
 
 
+    def test_candidate_tasks_skips_answered_tasks(self):
+        """Test SCHED candidate tasks skips tasks with enough answers"""
+        redis_flushall()
+        self.del_task_runs()
+        tasks = db.session.query(model.Task).filter_by(app_id=1)\
+                  .order_by('id').all()
+        first = tasks[0]
+        first.n_answers = 1
+        db.session.add(first)
+        db.session.commit()
+        tr = model.TaskRun(app_id=1, task_id=first.id, user_ip='127.0.0.9',
+                           info={'answer': 'Yes'})
+        db.session.add(tr)
+        db.session.commit()
+
+        candidates = pybossa.sched.get_candidate_tasks(1, user_ip='127.0.0.1')
+        err_msg = "The answered task should not be a candidate"
+        assert len(candidates) == 9, candidates
+        assert first.id not in [t.id for t in candidates], err_msg
+        assert candidates[0].id == tasks[1].id, err_msg
+        assert candidates[0].dictize()['info'] == tasks[1].info, err_msg
+
+
 class TestGetBreadthFirst:
     def setUp(self):
         model.rebuild_db()
@@ -415,10 +460,36 @@ class TestGetBreadthFirst:
     def test_get_random_task(self):
         self._test_get_random_task()
 
+    def test_get_random_task_uses_index(self):
+        """Test SCHED random task pivot bounds a scan of the open task index"""
+        sql = 'EXPLAIN ' + pybossa.sched.RANDOM_TASK_SQL % dict(
+            user_filter='user_ip=:user_ip')
+        conn = db.engine.connect()
+        try:
+            conn.execute('SET enable_seqscan = off')
+            rows = conn.execute(text(sql), app_id=1, user_ip='127.0.0.1',
+                                limit=1)
+            plan = '\n'.join(row[0] for row in rows)
+        finally:
+            conn.execute('RESET enable_seqscan')
+            conn.close()
+        assert 'task_app_id_id_open_idx' in plan, plan
+        # A float8 pivot would turn the id bound into a Filter on id::float8
+        assert '(id >= $' in plan, plan
+        assert 'double precision' not in plan, plan
+
     def _test_get_random_task(self, user=None):
         task = pybossa.sched.get_random_task(app_id=1)
         assert task is not None, task
 
+        # The tasks done by the user are never returned
+        done = [tr.task_id for tr in db.session.query(model.TaskRun)
+                .filter_by(user_ip='127.0.0.1').all()]
+        for i in range(10):
+            task = pybossa.sched.get_random_task(app_id=1,
+                                                 user_ip='127.0.0.1')
+            assert task.id not in done, task
+
         tasks = db.session.query(model.Task).all()
         for t in tasks:
             db.session.delete(t)
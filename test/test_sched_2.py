@@ -17,8 +17,13 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from helper import sched
-from base import Fixtures, redis_flushall, model
+from base import Fixtures, redis_flushall, model, redis_master, db
+import pybossa.sched_queue as sched_queue
+import pybossa.sched_lock as sched_lock
+import pybossa.sched_stats as sched_stats
 import json
+import time
+from mock import patch
 
 
 class TestSched(sched.Helper):
@@ -86,3 +91,122 @@ class TestSched(sched.Helper):
         # Check that we received a Task with answer
         assert data.get('info'), data
         assert data.get('info').get('last_answer').get('answer') == 'No No'
+
+    def test_depth_first_queue_tasks(self):
+        """ Test depth first queue SCHED strategy serves every task once"""
+        redis_flushall()
+        Fixtures.create(sched='depth_first_queue')
+        self.del_task_runs()
+
+        assigned_tasks = []
+        res = self.app.get('api/app/1/newtask')
+        data = json.loads(res.data)
+        while data.get('info') is not None:
+            assigned_tasks.append(data['id'])
+            tr = dict(app_id=data['app_id'], task_id=data['id'],
+                      info={'answer': 'No'})
+            self.app.post('/api/taskrun', data=json.dumps(tr))
+            res = self.app.get('api/app/1/newtask')
+            data = json.loads(res.data)
+
+        err_msg = "Every task should be served once"
+        assert len(assigned_tasks) == 10, err_msg
+        assert len(set(assigned_tasks)) == 10, err_msg
+        err_msg = "The queue of the app should be in Redis"
+        assert redis_master.exists(sched_queue.queue_key(1)), err_msg
+        done = redis_master.keys('sched_queue:1:done:ip:*')[0]
+        err_msg = "The done set of the IP should be a compact intset"
+        assert redis_master.scard(done) == 11, err_msg
+        assert redis_master.object('encoding', done) == 'intset', err_msg
+
+    def test_queue_dropped_on_commit(self):
+        """ Test SCHED queue is only dropped once task changes are committed"""
+        redis_flushall()
+        Fixtures.create(sched='depth_first_queue')
+        assert sched_queue.pop(1), "The queue should serve a task"
+        key = sched_queue.queue_key(1)
+
+        task = model.Task(app_id=1, info={})
+        db.session.add(task)
+        db.session.flush()
+        err_msg = "The queue should be kept until the commit"
+        assert redis_master.exists(key), err_msg
+        db.session.rollback()
+        assert redis_master.exists(key), err_msg
+
+        db.session.add(model.Task(app_id=1, info={}))
+        db.session.commit()
+        err_msg = "The queue should be dropped after the commit"
+        assert not redis_master.exists(key), err_msg
+
+    def test_task_reservations(self):
+        """ Test SCHED reserves tasks for as many users as answers needed"""
+        redis_flushall()
+        task = model.Task(id=1, n_answers=2, n_task_runs=1)
+
+        assert sched_lock.acquire(task, user_id=1), "Task should be free"
+        err_msg = "The user should keep its reservation"
+        assert sched_lock.acquire(task, user_id=1), err_msg
+        err_msg = "The task only needs one more answer"
+        assert not sched_lock.is_available(task, user_ip='127.0.0.1'), err_msg
+        assert not sched_lock.acquire(task, user_ip='127.0.0.1'), err_msg
+
+        sched_lock.release(task.id, user_id=1)
+        err_msg = "The task should be free after the answer is submitted"
+        assert sched_lock.acquire(task, user_ip='127.0.0.1'), err_msg
+
+        redis_flushall()
+        now = time.time()
+        with patch('pybossa.sched_lock.time.time', return_value=now):
+            assert sched_lock.acquire(task, user_id=1, timeout=5), err_msg
+            err_msg = "The reservation should not be expired yet"
+            assert not sched_lock.is_available(task, user_ip='127.0.0.1'), \
+                err_msg
+        with patch('pybossa.sched_lock.time.time', return_value=now + 6):
+            err_msg = "Expired reservations should be ignored"
+            assert sched_lock.is_available(task, user_ip='127.0.0.1'), err_msg
+
+    def test_task_reservation_released_on_commit(self):
+        """ Test SCHED releases a reservation once its TaskRun is committed"""
+        redis_flushall()
+        Fixtures.create()
+        # The task has one answer, so it only needs one more
+        task = db.session.query(model.Task).get(1)
+        task.n_answers = 2
+        db.session.commit()
+        task = db.session.query(model.Task).get(1)
+        assert sched_lock.acquire(task, user_ip='10.0.2.1'), "Task is free"
+
+        db.session.add(model.TaskRun(app_id=1, task_id=1,
+                                     user_ip='10.0.2.1'))
+        db.session.flush()
+        err_msg = "The reservation should be kept until the commit"
+        assert not sched_lock.is_available(task, user_ip='10.0.2.2'), err_msg
+        db.session.rollback()
+        assert not sched_lock.is_available(task, user_ip='10.0.2.2'), err_msg
+
+        db.session.add(model.TaskRun(app_id=1, task_id=1,
+                                     user_ip='10.0.2.1'))
+        db.session.commit()
+        err_msg = "The reservation should be released after the commit"
+        assert not redis_master.zscore(sched_lock.lock_key(1), 'ip:10.0.2.1'), \
+            err_msg
+
+    def test_scheduler_stats(self):
+        """ Test SCHED records the latency and DB queries of the schedulers"""
+        redis_flushall()
+        Fixtures.create(sched='breadth_first')
+        for i in range(3):
+            self.app.get('api/app/1/newtask')
+
+        stats = sched_stats.get_stats('breadth_first')
+        err_msg = "Every call to the scheduler should be recorded"
+        assert stats['calls'] == 3, err_msg
+        err_msg = "The scheduler should run at least one query per call"
+        assert stats['queries'] >= 1, err_msg
+        assert stats['p50'] <= stats['p95'] <= stats['p99'], stats
+        err_msg = "Other schedulers should have no calls"
+        assert sched_stats.get_stats('random')['calls'] == 0, err_msg
+
+        sched_stats.reset_stats('breadth_first')
+        assert sched_stats.get_stats('breadth_first')['calls'] == 0
@@ -20,6 +20,7 @@ import datetime
 import time
 from base import web, model, db, Fixtures, redis_flushall
 import pybossa.stats as stats
+from mock import patch
 
 
 class TestStats:
@@ -166,3 +167,147 @@ class TestStats:
 
             err_msg = "date stats sum of auth and anon should be 10"
             assert user_stats['n_anon'] + user_stats['n_auth'], err_msg
+
+    def test_04_stats_aggregated_by_day_and_hour(self):
+        """Test STATS dates and hours are split by day, hour and user"""
+        for finish_time, user_id in [('2013-01-01T10:00:00.000001', None),
+                                     ('2013-01-01T10:59:59.999999', 1),
+                                     ('2013-01-02T23:30:00', None)]:
+            task_run = model.TaskRun(app_id=1, task_id=1, user_id=user_id,
+                                     user_ip=None if user_id else '10.0.0.1',
+                                     finish_time=finish_time)
+            db.session.add(task_run)
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            dates, dates_n_tasks, dates_anon, dates_auth = stats.stats_dates(1)
+            assert dates['2013-01-01'] == 2, dates
+            assert dates_anon['2013-01-01'] == 1, dates_anon
+            assert dates_auth['2013-01-01'] == 1, dates_auth
+            assert dates['2013-01-02'] == 1, dates
+            assert '2013-01-02' not in dates_auth, dates_auth
+
+            hours, hours_anon, hours_auth, max_hours,\
+                max_hours_anon, max_hours_auth = stats.stats_hours(1)
+            assert hours['10'] == 2, hours
+            assert hours_anon['10'] == 1 and hours_auth['10'] == 1
+            assert hours['23'] == 1 and hours_auth['23'] == 0, hours
+            assert len(hours) == 24, hours
+
+    def test_05_rollup(self):
+        """Test STATS rollup gives the same stats as the task runs"""
+        with self.app.test_request_context('/'):
+            dates = stats.stats_dates(1)
+            hours = stats.stats_hours(1)
+
+            err_msg = "The first run waits for the running transactions"
+            assert stats.update_rollup(batch_size=3) == 0, err_msg
+            assert stats.update_rollup(batch_size=3) == 3
+            assert stats.stats_dates(1) == dates, "Half rolled up"
+            assert stats.update_rollup() > 0
+            assert stats.update_rollup() == 0, "Nothing left to roll up"
+            n_rows = db.session.query(model.TaskRunDailyRollup).count()
+            assert n_rows > 0, n_rows
+            assert stats.stats_dates(1) == dates
+            assert stats.stats_hours(1) == hours
+
+            # New task runs are counted before they are rolled up
+            db.session.add(model.TaskRun(app_id=1, task_id=1,
+                                         user_ip='10.0.0.1'))
+            db.session.commit()
+            today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+            new_dates = stats.stats_dates(1)[0]
+            assert new_dates[today] == dates[0][today] + 1, new_dates
+
+            # Deleted task runs are removed from the rollup
+            task_run = db.session.query(model.TaskRun)\
+                .filter_by(app_id=1)\
+                .filter(model.TaskRun.finish_time != None)\
+                .order_by(model.TaskRun.id).first()
+            day = task_run.finish_time[:10]
+            n_answers = stats.stats_dates(1)[0][day]
+            db.session.delete(task_run)
+            db.session.commit()
+            new_dates = stats.stats_dates(1)[0]
+            assert new_dates.get(day, 0) == n_answers - 1, new_dates
+
+            stats.delete_rollup(1)
+            n_rows = db.session.query(model.TaskRunDailyRollup).count()
+            assert n_rows == 0, n_rows
+
+    def test_06_format_dates_benchmark(self):
+        """Test STATS dates formatting converts every date only once, and is
+        faster than parsing them once per series"""
+        days = [(datetime.date(2010, 1, 1) + datetime.timedelta(i))
+                .strftime('%Y-%m-%d') for i in range(1500)]
+        dates = dict((d, 10) for d in days)
+        dates_n_tasks = dict((d, 100) for d in days)
+        dates_anon = dict((d, 4) for d in days[::2])
+        dates_auth = dict((d, 6) for d in days[::3])
+        dates_estimate = dict((d, 20) for d in days[-10:])
+        args = (1, dates, dates_n_tasks, dates_estimate, dates_anon,
+                dates_auth)
+
+        with self.app.test_request_context('/'):
+            with patch('pybossa.stats.date_to_ms',
+                       side_effect=stats.date_to_ms) as date_to_ms:
+                out = stats.stats_format_dates.uncached(*args)
+            assert len(out[0]['values']) == len(days), out[0]
+            ms = int(time.mktime(time.strptime(days[0], "%Y-%m-%d")) * 1000)
+            assert out[0]['values'][0] == [ms, 10], out[0]['values'][0]
+            assert out[1]['values'][1] == [ms + 24 * 3600 * 1000, 0], out[1]
+            n_calls = len(days) + len(dates_estimate)
+            err_msg = "Every date should be converted once"
+            assert date_to_ms.call_count == n_calls, err_msg
+
+            # The old formatter parsed every date with strptime once per
+            # series. The timing is noisy, so only a generous bound is checked
+            def reference():
+                for d in days * 5:
+                    time.mktime(time.strptime(d, "%Y-%m-%d"))
+            elapsed = self._best_time(stats.stats_format_dates.uncached, *args)
+            reference_elapsed = self._best_time(reference)
+            err_msg = "Formatting should be faster than parsing every date " \
+                "once per series: %.4fs >= %.4fs" % (elapsed, reference_elapsed)
+            assert elapsed < reference_elapsed, err_msg
+
+    def _best_time(self, f, *args):
+        times = []
+        for i in range(3):
+            start = time.time()
+            f(*args)
+            times.append(time.time() - start)
+        return min(times)
+
+    def test_07_stats_key(self):
+        """Test STATS formatters are memoized by app and data version"""
+        with self.app.test_request_context('/'):
+            key = stats.stats_key(1, dict(a=1), dict(b=2))
+            assert key == '1:%s' % stats.data_version(1), key
+            db.session.add(model.TaskRun(app_id=1, task_id=1,
+                                         user_ip='10.0.0.1'))
+            db.session.commit()
+            new_key = stats.stats_key(1, dict(a=1), dict(b=2))
+            assert new_key != key, "A new answer should change the version"
+            assert stats.stats_key(2) != new_key, "Each app has its version"
+
+            version = int(stats.data_version(1))
+            for i in range(2):
+                db.session.add(model.TaskRun(app_id=1, task_id=1,
+                                             user_ip='10.0.1.%s' % i))
+            db.session.flush()
+            err_msg = "The version should only change on commit"
+            assert int(stats.data_version(1)) == version, err_msg
+            db.session.commit()
+            err_msg = "The version should change once per commit"
+            assert int(stats.data_version(1)) == version + 1, err_msg
+            db.session.add(model.TaskRun(app_id=1, task_id=1,
+                                         user_ip='10.0.1.3'))
+            db.session.flush()
+            db.session.rollback()
+            err_msg = "Rolled back answers should not change the version"
+            assert int(stats.data_version(1)) == version + 1, err_msg
+            stats.bump_data_version(1, 2)
+            err_msg = "Raw SQL writers should change the version too"
+            assert int(stats.data_version(1)) == version + 2, err_msg
+            key = stats.stats_users_key(1, {}, [], [], geo=True)
+            assert key == stats.stats_key(1) + ':True', key
@@ -2767,11 +2767,14 @@ class TestWeb(web.Helper):
             # Correct values
             err_msg = "There should be a %s section" % form_id
             assert dom.find(id=form_id) is not None, err_msg
-            res = self.task_settings_redundancy(short_name=self.app_short_name,
-                                                n_answers=n_answers)
+            with patch('pybossa.sched_queue.delete_queue') as delete_queue:
+                res = self.task_settings_redundancy(
+                    short_name=self.app_short_name, n_answers=n_answers)
             dom = BeautifulSoup(res.data)
             err_msg = "Task Redundancy should be updated"
             assert dom.find(id='msg_success') is not None, err_msg
+            # The task queue of the app should be dropped
+            delete_queue.assert_called_once_with(1)
             app = db.session.query(model.App).get(1)
             for t in app.tasks:
                 assert t.n_answers == n_answers, err_msg